@@ -0,0 +1,54 @@
+
+# file delivery for the add pg no fastapi
+#
+# starlette's FileResponse already does the heavy lifting: byte ranges (single
+# and multipart), If-Range, HEAD, and http.response.pathsend so servers that
+# support it hand the file to sendfile() without it passing through python.
+# on top of that we set a cheap strong ETag from the file's size and mtime and
+# answer If-None-Match with 304 before touching the file.
+
+import os
+import sys
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.transfer import content_disposition
+
+
+def file_etag(stat_result):
+    return f'"{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match is "*" or a list of (possibly weak) tags, compared weakly
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+def file_response(request: Request, path, filename, inline=False, headers=None):
+    stat_result = os.stat(path)
+    etag = file_etag(stat_result)
+    response_headers = {
+        "ETag": etag,
+        "Cache-Control": "private, max-age=3600",
+        "Content-Disposition": content_disposition(filename, inline),
+    }
+    response_headers.update(headers or {})
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and request.method in ("GET", "HEAD") and etag_matches(if_none_match, etag):
+        not_modified = {key: value for key, value in response_headers.items() if key != "Content-Disposition"}
+        return Response(status_code=304, headers=not_modified)
+
+    # stat_result is passed on so the file is only stat'ed once
+    return FileResponse(
+        path,
+        media_type="application/pdf",
+        headers=response_headers,
+        stat_result=stat_result,
+    )
@@ -5,17 +5,21 @@
 
 
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Request
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 import fitz 
 import os
 import uuid
 import shutil
+from urllib.parse import quote
 from typing import Optional
 from pydantic import BaseModel
 import uvicorn
 
+from numbering import number_pages, DEFAULT_FORMAT
+from download import file_response
+
 
 
 app = FastAPI(title="PDF Page Numbering API")
@@ -43,41 +47,59 @@ class PageNumberResponse(BaseModel):
     message: str
     download_url: Optional[str] = None
 
-def add_page_numbers(input_path, output_path):
+def add_page_numbers(input_path, output_path, incremental=False, **options):
     try:
 
         doc = fitz.open(input_path)
         
-        total_pages = len(doc)
-        
-        for page_num in range(total_pages):
-            page = doc[page_num]
-            
-            text = f" {page_num + 1} "
-        
-            text_width = fitz.get_text_length(text, fontname="helv", fontsize=8)
-            page_rect = page.rect
-            x = (page_rect.width - text_width) / 2
-
-            y = page_rect.height - 15                # 30 points from bottom        # 30
-            
-            page.insert_text((x, y), text, fontname="helv", fontsize=10)
+        number_pages(doc, **options)
         
+        if incremental and doc.can_save_incrementally():
+            # the upload is our own copy: append only the changed objects to it
+            # and move it into place instead of rewriting every object
+            doc.saveIncr()
+            doc.close()
+            os.replace(input_path, output_path)
+            return True
+
+        # files mupdf had to repair on open cannot take an incremental update
         doc.save(output_path)
         return True
+    except ValueError:
+        # bad options, the caller reports these to the client
+        raise
     except Exception as e:
         print(f"Error processing PDF: {e}")
         return False
 
+def output_file(file_id, output_filename):
+    # only names this service produced, nothing outside OUTPUT_FOLDER
+    try:
+        uuid.UUID(file_id)
+    except ValueError:
+        return None
+    if os.path.basename(output_filename) != output_filename or not output_filename.endswith("_numbered.pdf"):
+        return None
+    path = os.path.join(OUTPUT_FOLDER, f"{file_id}_{output_filename}")
+    return path if os.path.isfile(path) else None
+
+
 @app.get("/")
 async def root():
     return {"message": "PDF Page Numbering API. Use /add-page-numbers to process a PDF file."}
 
 @app.post("/addpgno", response_model=PageNumberResponse)
 async def create_numbered_pdf(
+    request: Request,
     file: UploadFile = File(...),
     position: str = Form("bottom", description="Position of page numbers (bottom, top, etc.)"),
-    custom_text: Optional[str] = Form(None, description="Optional custom text format")
+    custom_text: Optional[str] = Form(None, description="Optional custom text format"),
+    start: int = Form(1, description="Number printed on the first numbered page"),
+    first_page: int = Form(1, description="First page that gets a number"),
+    skip: Optional[str] = Form(None, description="Pages left without a number, e.g. 1-2,5"),
+    font_size: float = Form(10, description="Font size of the page numbers"),
+    incremental: bool = Form(False, description="Append the numbers as an incremental update and stream the PDF back"),
+    inline: bool = Form(False, description="Send the numbered PDF in this response instead of a download link")
 ):
 
     if not file.filename.endswith('.pdf'):
@@ -97,7 +119,20 @@ async def create_numbered_pdf(
     
     # Process the PDF
 
-    success = add_page_numbers(input_path, output_path)
+    options = {
+        "fmt": custom_text or DEFAULT_FORMAT,
+        "position": position,
+        "start": start,
+        "first_page": first_page,
+        "skip": skip,
+        "fontsize": font_size,
+    }
+    try:
+        success = add_page_numbers(input_path, output_path, incremental=incremental, **options)
+    except ValueError as e:
+        if os.path.exists(input_path):
+            os.remove(input_path)
+        raise HTTPException(status_code=400, detail=str(e))
     
     if not success:
         # Clean up the input file
@@ -113,6 +148,10 @@ async def create_numbered_pdf(
     base_url = "http://localhost:8000"  
     download_url = f"{base_url}/download/{file_id}/{output_filename}"
     
+    if inline or incremental:
+        # saves the client a second round trip to /download
+        return file_response(request, output_path, output_filename, headers={"X-Download-Url": quote(download_url, safe=":/")})
+
     return PageNumberResponse(
         success=True,
         message="Page numbers added successfully",
@@ -120,5 +159,13 @@ async def create_numbered_pdf(
     )
 
 
+@app.api_route("/download/{file_id}/{output_filename}", methods=["GET", "HEAD"])
+async def download_numbered_pdf(request: Request, file_id: str, output_filename: str, inline: bool = False):
+    path = output_file(file_id, output_filename)
+    if path is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    return file_response(request, path, output_filename, inline=inline)
+
+
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,234 @@
+
+# page numbering used by the add pg no fastapi (and the pdf sessions service)
+#
+# all font work happens once per document: glyph widths come from a table built
+# once per font, the font resource is a single object shared by every page and
+# pages of the same size and rotation share one prepared stamp (placement and
+# text matrix). per page only the number text is formatted and a few bytes of
+# content stream are appended, so big files are bounded by the save, not by us.
+
+import re
+import string
+from functools import lru_cache
+
+import fitz
+
+
+DEFAULT_FORMAT = " {n} "
+
+# base 14 fonts, used without embedding anything
+FONTS = {
+    "helv": "Helvetica",
+    "hebo": "Helvetica-Bold",
+    "heit": "Helvetica-Oblique",
+    "tiro": "Times-Roman",
+    "tibo": "Times-Bold",
+    "tiit": "Times-Italic",
+    "cour": "Courier",
+    "cobo": "Courier-Bold",
+    "coit": "Courier-Oblique",
+}
+
+# resource name of the stamp font, kept apart from the page's own fonts
+FONT_RESOURCE = "PgNoFont"
+
+# position -> (horizontal alignment, vertical edge)
+POSITIONS = {
+    "bottom": (0.5, "bottom"),
+    "bottom-center": (0.5, "bottom"),
+    "bottom-left": (0.0, "bottom"),
+    "bottom-right": (1.0, "bottom"),
+    "top": (0.5, "top"),
+    "top-center": (0.5, "top"),
+    "top-left": (0.0, "top"),
+    "top-right": (1.0, "top"),
+}
+
+FORMAT_FIELDS = {"n", "total"}
+
+
+@lru_cache(maxsize=None)
+def glyph_widths(fontname):
+    # advance of every WinAnsi character at fontsize 1
+    font = fitz.Font(fontname)
+    widths = {}
+    for code in range(32, 256):
+        try:
+            char = bytes([code]).decode("cp1252")
+        except UnicodeDecodeError:
+            continue
+        widths[char] = font.text_length(char, fontsize=1)
+    return widths
+
+
+def text_width(text, fontname, fontsize):
+    widths = glyph_widths(fontname)
+    missing = widths.get("?", 0.5)
+    return sum(widths.get(char, missing) for char in text) * fontsize
+
+
+def check_format(fmt):
+    # raises ValueError for anything str.format would choke on later
+    for _, field, _, _ in string.Formatter().parse(fmt):
+        if field is None:
+            continue
+        if field not in FORMAT_FIELDS:
+            raise ValueError(f"Unknown field '{{{field}}}' in format, use {{n}} and {{total}}")
+    fmt.format(n=1, total=1)
+    return fmt
+
+
+def parse_pages(expression, total_pages):
+    # "1-3,7" -> {0, 1, 2, 6}, pages past the end are ignored
+    pages = set()
+    if not expression:
+        return pages
+    for token in expression.replace(" ", "").split(","):
+        if not token:
+            continue
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", token)
+        if match is None:
+            raise ValueError(f"Invalid page range '{token}'")
+        first = int(match.group(1))
+        last = int(match.group(2) or first)
+        if first < 1 or first > last:
+            raise ValueError(f"Invalid page range '{token}'")
+        pages.update(range(first - 1, min(last, total_pages)))
+    return pages
+
+
+def _pdf_string(text):
+    data = text.encode("cp1252", "replace")
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+class Stamp:
+    # everything about a number stamp that depends only on the page geometry
+
+    def __init__(self, page, align, edge, fontsize, margin):
+        rect = page.rect
+        self.align = align
+        self.left = margin
+        self.width = rect.width - 2 * margin
+        self.y = rect.height - margin if edge == "bottom" else margin + fontsize
+        # visible (rotated, top-left origin) space -> pdf user space
+        self.matrix = ~page.rotation_matrix * ~page.transformation_matrix
+        # text runs left to right and upright as seen by the reader
+        a = fitz.Point(1, 0) * self.matrix - fitz.Point(0, 0) * self.matrix
+        c = fitz.Point(0, -1) * self.matrix - fitz.Point(0, 0) * self.matrix
+        self.axes = f"{a.x:g} {a.y:g} {c.x:g} {c.y:g}"
+
+    def content(self, text, width, font_ref, fontsize):
+        x = self.left + (self.width - width) * self.align
+        origin = fitz.Point(x, self.y) * self.matrix
+        return (
+            b"Q\nBT\n0 g\n/%s %g Tf\n%s %g %g Tm\n(%s) Tj\nET\n"
+            % (font_ref.encode(), fontsize, self.axes.encode(), origin.x, origin.y, _pdf_string(text))
+        )
+
+
+def _ref(value):
+    # "12 0 R" -> 12
+    return int(value.split()[0])
+
+
+def _append_content(doc, page_xref, stream_xref, wrap_xref):
+    # contents become [q, <old contents>, stamp]; the leading q and the Q at the
+    # start of the stamp keep whatever state the old contents leave behind
+    kind, value = doc.xref_get_key(page_xref, "Contents")
+    if kind == "xref" and not doc.xref_is_stream(_ref(value)):
+        # an indirect array of streams
+        kind, value = "array", doc.xref_object(_ref(value), compressed=True)
+    if kind == "array":
+        old = value.strip()[1:-1].strip()
+    elif kind == "xref":
+        old = value
+    else:
+        old = ""
+    doc.xref_set_key(page_xref, "Contents", f"[{wrap_xref} 0 R {old} {stream_xref} 0 R]")
+
+
+def _add_font(doc, page_xref, name, font_xref, done):
+    # puts /name into the page's font resources. pages usually share their
+    # resources, `done` remembers the dictionaries that already have it
+    kind, value = doc.xref_get_key(page_xref, "Resources")
+    if kind == "null":
+        # inherited from the page tree, give the page its own reference to it
+        parent = page_xref
+        while kind == "null":
+            parent_kind, parent_value = doc.xref_get_key(parent, "Parent")
+            if parent_kind != "xref":
+                break
+            parent = _ref(parent_value)
+            kind, value = doc.xref_get_key(parent, "Resources")
+        doc.xref_set_key(page_xref, "Resources", value if kind in ("xref", "dict") else "<<>>")
+        kind, value = doc.xref_get_key(page_xref, "Resources")
+
+    if kind == "xref":
+        holder, path = _ref(value), "Font"
+    else:
+        holder, path = page_xref, "Resources/Font"
+    if (holder, path) in done:
+        return
+    font_kind, font_value = doc.xref_get_key(holder, path)
+    if font_kind == "xref":
+        doc.xref_set_key(_ref(font_value), name, f"{font_xref} 0 R")
+    elif font_kind == "dict":
+        doc.xref_set_key(holder, f"{path}/{name}", f"{font_xref} 0 R")
+    else:
+        doc.xref_set_key(holder, path, f"<< /{name} {font_xref} 0 R >>")
+    if holder != page_xref:
+        done.add((holder, path))
+
+
+def number_pages(doc, fmt=DEFAULT_FORMAT, position="bottom", start=1, first_page=1, skip=None,
+                 fontname="helv", fontsize=10, margin=15):
+    # stamps page numbers on an open document and returns how many pages got one.
+    # numbering starts at `start` on page `first_page` (1-based); pages in `skip`
+    # ("1-2,5") are left blank and do not use up a number. {total} is the last
+    # number printed.
+    if position not in POSITIONS:
+        raise ValueError(f"Invalid position '{position}', use one of: {', '.join(POSITIONS)}")
+    if fontname not in FONTS:
+        raise ValueError(f"Invalid font '{fontname}', use one of: {', '.join(FONTS)}")
+    if fontsize <= 0:
+        raise ValueError("Font size must be positive")
+    check_format(fmt)
+
+    total_pages = len(doc)
+    skipped = parse_pages(skip, total_pages)
+    pages = [index for index in range(max(first_page, 1) - 1, total_pages) if index not in skipped]
+    if not pages:
+        return 0
+    total = start + len(pages) - 1
+    align, edge = POSITIONS[position]
+
+    # read every page before changing anything, mupdf drops its page lookup
+    # cache whenever the document is modified
+    stamps = {}
+    targets = []
+    for index in pages:
+        page = doc[index]
+        key = (tuple(page.mediabox), tuple(page.cropbox), page.rotation)
+        stamp = stamps.get(key)
+        if stamp is None:
+            stamp = stamps[key] = Stamp(page, align, edge, fontsize, margin)
+        targets.append((page.xref, stamp))
+
+    font_xref = doc.get_new_xref()
+    doc.update_object(font_xref, f"<< /Type /Font /Subtype /Type1 /BaseFont /{FONTS[fontname]} /Encoding /WinAnsiEncoding >>")
+    wrap_xref = doc.get_new_xref()
+    doc.update_object(wrap_xref, "<<>>")
+    doc.update_stream(wrap_xref, b"q\n")
+
+    done = set()
+    for number, (page_xref, stamp) in enumerate(targets, start=start):
+        text = fmt.format(n=number, total=total)
+        content = stamp.content(text, text_width(text, fontname, fontsize), FONT_RESOURCE, fontsize)
+        stream_xref = doc.get_new_xref()
+        doc.update_object(stream_xref, "<<>>")
+        doc.update_stream(stream_xref, content)
+        _add_font(doc, page_xref, FONT_RESOURCE, font_xref, done)
+        _append_content(doc, page_xref, stream_xref, wrap_xref)
+
+    return len(pages)
@@ -0,0 +1,120 @@
+
+# batch.py
+
+# background removal for many images in one request. the uploads (single images
+# or zips of them) are spooled to disk by the handler, the form files may be
+# closed before the response body runs. the images are cut into groups of
+# BATCH_SIZE; each group is decoded, run through the model as one onnx batch
+# and encoded to png on the inference executor, and the pngs are streamed back
+# in a zip as the groups finish.
+
+import functools
+import io
+import os
+import posixpath
+import zipfile
+
+from PIL import Image
+
+
+# images per onnx run
+BATCH_SIZE = int(os.environ.get("REMBG_BATCH_SIZE", 8))
+# images per request, zips included
+MAX_BATCH_IMAGES = int(os.environ.get("MAX_BATCH_IMAGES", 500))
+
+
+class BatchError(ValueError):
+    pass
+
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def list_images(uploads, is_image):
+    # uploads is [(filename, spooled path)]. returns ([(name, read)], archives):
+    # every image in the uploads, in order, with the zips opened up. read()
+    # returns the image's bytes, nothing is read here. the caller closes the
+    # archives once every image has been read
+    entries = []
+    archives = []
+    try:
+        for filename, path in uploads:
+            if filename.lower().endswith(".zip"):
+                try:
+                    archive = zipfile.ZipFile(path)
+                except zipfile.BadZipFile:
+                    raise BatchError(f"{filename}: not a valid zip file")
+                archives.append(archive)
+                for info in archive.infolist():
+                    name = posixpath.basename(info.filename)
+                    if info.is_dir() or info.filename.startswith("__MACOSX/") or not is_image(name):
+                        continue
+                    entries.append((name, functools.partial(archive.read, info)))
+            elif is_image(filename):
+                entries.append((filename, functools.partial(read_file, path)))
+            else:
+                raise BatchError(f"images or zip files only ({filename})")
+        if not entries:
+            raise BatchError("no images found in the upload")
+        if len(entries) > MAX_BATCH_IMAGES:
+            raise BatchError(f"at most {MAX_BATCH_IMAGES} images per request")
+    except Exception:
+        close_archives(archives)
+        raise
+    return entries, archives
+
+
+def close_archives(archives):
+    for archive in archives:
+        archive.close()
+
+
+def read_group(entries):
+    # [(name, image bytes)], reading zip entries decompresses them so this runs
+    # off the event loop
+    return [(name, read()) for name, read in entries]
+
+
+def output_name(name, used):
+    # photo.jpg -> photo.png, photo_2.png if that is taken already
+    stem = os.path.splitext(name)[0] or "image"
+    candidate, number = f"{stem}.png", 1
+    while candidate in used:
+        number += 1
+        candidate = f"{stem}_{number}.png"
+    used.add(candidate)
+    return candidate
+
+
+def remove_group(sessions, items):
+    # runs on the inference executor. items is [(name, image bytes)], returns
+    # [(name, png bytes, None)] or [(name, None, error)] where error is
+    # "unreadable" (the image couldn't be decoded) or "failed" (inference did
+    # not go through), so one bad group never ends the stream
+    images = []
+    for name, data in items:
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                images.append(image.convert("RGB"))
+        except Exception:
+            images.append(None)
+
+    readable = [image for image in images if image is not None]
+    try:
+        masks = iter(sessions.masks(readable) if readable else [])
+    except Exception:
+        return [(name, None, "unreadable" if image is None else "failed") for (name, _), image in zip(items, images)]
+
+    results = []
+    for (name, _), image in zip(items, images):
+        if image is None:
+            results.append((name, None, "unreadable"))
+            continue
+        image.putalpha(next(masks))
+        buffer = io.BytesIO()
+        image.save(buffer, "PNG")
+        results.append((name, buffer.getvalue(), None))
+    return results
+
@@ -1,14 +1,40 @@
 # FastAPI Background Remover API
 
 import os
+import sys
+import json
 import uuid
+import asyncio
+import zipfile
+from collections import deque
+from typing import List
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
 from PIL import Image
-from rembg import remove
 
-app = FastAPI(title="Background Remover API")
+from batch import (
+    BATCH_SIZE, BatchError, close_archives, list_images, output_name, read_group, remove_group,
+)
+from session_pool import RembgSessionPool
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.transfer import ZipSink, spool_upload
+
+# the model is loaded and warmed up once, before the first request
+sessions = RembgSessionPool()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sessions.start()
+    yield
+    sessions.shutdown()
+
+
+app = FastAPI(title="Background Remover API", lifespan=lifespan)
 
 os.makedirs("uploaded_images", exist_ok=True)
 os.makedirs("bgremoved_images", exist_ok=True)
@@ -17,10 +43,23 @@ app.mount("/files", StaticFiles(directory="bgremoved_images"), name="files")
 
 ALLOWED_EXTENSIONS = {"jpg", "jpeg", "png", "bmp", "gif", "tiff"}
 
+
 def is_valid_image(filename: str) -> bool:
     
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+def remove_background_file(upload_path, output_path):
+    # runs on the inference executor
+    with Image.open(upload_path) as input_img:
+        output_img = sessions.remove(input_img)
+    output_img.save(output_path)
+
+
+@app.get("/metrics")
+async def metrics():
+    return sessions.stats()
+
 @app.post("/remove-background")
 async def remove_background(file: UploadFile = File(...)):
 
@@ -43,12 +82,9 @@ async def remove_background(file: UploadFile = File(...)):
         with open(upload_path, "wb") as buffer:
             buffer.write(await file.read())
         
-        input_img = Image.open(upload_path)
-        output_img = remove(input_img)
-        
         output_filename = f"{unique_id}.png"
         output_path = os.path.join("bgremoved_images", output_filename)
-        output_img.save(output_path)
+        await sessions.run(remove_background_file, upload_path, output_path)
         
         download_link = f"http://127.0.0.1:8000/files/{output_filename}"
         
@@ -68,7 +104,90 @@ async def remove_background(file: UploadFile = File(...)):
         )
 
 
-#  this is the last working file of friday its working well.
+async def stream_batch(entries, archives):
+    # groups of BATCH_SIZE images go to the inference executor, one more than
+    # there are sessions so the next group is decoded while the others run.
+    # the pngs are zipped (stored, png is compressed already) in upload order
+    loop = asyncio.get_running_loop()
+    sink = ZipSink()
+    archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED)
+    pending = deque()
+    used = set()
+    errors = {"unreadable": [], "failed": []}
+
+    async def write_next():
+        for name, data, error in await pending.popleft():
+            if error is not None:
+                errors[error].append(name)
+            else:
+                archive.writestr(output_name(name, used), data)
+
+    try:
+        for start in range(0, len(entries), BATCH_SIZE):
+            items = await loop.run_in_executor(None, read_group, entries[start:start + BATCH_SIZE])
+            pending.append(asyncio.ensure_future(sessions.run(remove_group, sessions, items)))
+            if len(pending) > sessions.size:
+                await write_next()
+                yield sink.take()
+        while pending:
+            await write_next()
+            yield sink.take()
+        if errors["unreadable"] or errors["failed"]:
+            archive.writestr("errors.json", json.dumps({
+                "unreadable_images": errors["unreadable"],
+                "failed_images": errors["failed"],
+            }, indent=2))
+        archive.close()
+        yield sink.take()
+    finally:
+        # the client went away, don't run the groups nobody will read
+        for task in pending:
+            task.cancel()
+        close_archives(archives)
+
+
+@app.post("/remove-background/batch")
+async def remove_background_batch(files: List[UploadFile] = File(...)):
+
+    # any number of images and / or zip files of images. the response is a zip
+    # of the cut-out pngs, streamed while the later images are still running.
+    # the uploads are spooled to uploaded_images first, the form files can be
+    # closed before the response body is streamed
 
+    try:
+        uploads = []
+        for file in files:
+            _, ext = os.path.splitext(file.filename)
+            upload_path = os.path.join("uploaded_images", f"{uuid.uuid4()}{ext}")
+            await spool_upload(file, upload_path)
+            uploads.append((file.filename, upload_path))
+        entries, archives = await asyncio.get_running_loop().run_in_executor(None, list_images, uploads, is_valid_image)
+    except BatchError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+
+    return StreamingResponse(
+        stream_batch(entries, archives),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": 'attachment; filename="bgremoved_images.zip"',
+            "X-Image-Count": str(len(entries)),
+        },
+    )
+
+#  this is the last working file of friday its working well.
 
 
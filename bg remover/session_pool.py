@@ -0,0 +1,148 @@
+
+# session_pool.py
+
+# rembg model sessions shared by the bg remover and bg white apis. without a
+# session rembg.remove() builds a new onnx session on every call, and the
+# inference runs on the event loop. here the model is loaded once per worker
+# process into a small pool of inference sessions, warmed up at startup, and
+# every request runs on a dedicated executor with one thread per session, so a
+# request only pays for the inference itself.
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+from rembg import new_session, remove
+
+
+# rembg's own default model. others: u2netp (small, fast), isnet-general-use,
+# u2net_human_seg, silueta, ...
+REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+# inference sessions (and executor threads); each one holds its own copy of the model
+REMBG_SESSIONS = int(os.environ.get("REMBG_SESSIONS", 1))
+# onnxruntime threads per inference, by default the cores split between the sessions
+REMBG_THREADS = int(os.environ.get("REMBG_THREADS", max(1, (os.cpu_count() or 1) // REMBG_SESSIONS)))
+
+WARMUP_SIZE = (320, 320)
+
+# models whose onnx input can take several images at once: (mean, std, input
+# size), as rembg's session classes normalize them. other models are run
+# through session.predict() one image at a time
+BATCH_MODELS = {
+    "u2net": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2netp": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "u2net_human_seg": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "silueta": ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)),
+    "isnet-general-use": ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
+
+def predict_batch(session, images, mean, std, size):
+    # alpha masks for images, the images resized to the model's input size and
+    # stacked into one onnx run. a model exported with a fixed batch size gets
+    # runs of that size instead
+    model_input = session.inner_session.get_inputs()[0]
+    batch_size = model_input.shape[0]
+    step = batch_size if isinstance(batch_size, int) and batch_size > 0 else max(1, len(images))
+    masks = []
+    for start in range(0, len(images), step):
+        chunk = images[start:start + step]
+        inputs = np.concatenate([session.normalize(image, mean, std, size)[model_input.name] for image in chunk])
+        predictions = session.inner_session.run(None, {model_input.name: inputs})[0][:, 0, :, :]
+        for image, prediction in zip(chunk, predictions):
+            # scaled per image, as rembg does for a single one
+            low, high = prediction.min(), prediction.max()
+            prediction = (prediction - low) / ((high - low) or 1)
+            mask = Image.fromarray((prediction * 255).astype("uint8"), mode="L")
+            masks.append(mask.resize(image.size, Image.Resampling.LANCZOS))
+    return masks
+
+
+class RembgSessionPool:
+
+    def __init__(self, model_name=REMBG_MODEL, size=REMBG_SESSIONS, threads=REMBG_THREADS):
+        self.model_name = model_name
+        self.size = max(1, size)
+        self.threads = max(1, threads)
+        self._sessions = queue.Queue()
+        self._executor = None
+        self._lock = threading.Lock()
+        self.images = 0
+        self.inference_seconds = 0.0
+        self.load_seconds = None
+
+    def start(self):
+        # load and warm up every session, blocks until the pool is ready
+        began = time.perf_counter()
+        # rembg reads the onnxruntime thread counts from OMP_NUM_THREADS when
+        # it builds a session
+        os.environ["OMP_NUM_THREADS"] = str(self.threads)
+        warmup = Image.new("RGB", WARMUP_SIZE, (255, 255, 255))
+        for _ in range(self.size):
+            session = new_session(self.model_name)
+            # the first run allocates onnxruntime's buffers, do it before a client waits
+            remove(warmup, session=session)
+            self._sessions.put(session)
+        self._executor = ThreadPoolExecutor(max_workers=self.size, thread_name_prefix="rembg")
+        self.load_seconds = time.perf_counter() - began
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+
+    def remove(self, image, **kwargs):
+        # rembg.remove() on a free session. blocking, meant for the executor
+        # (which has one thread per session, so a session is always free)
+        session = self._sessions.get()
+        try:
+            began = time.perf_counter()
+            result = remove(image, session=session, **kwargs)
+            elapsed = time.perf_counter() - began
+        finally:
+            self._sessions.put(session)
+        with self._lock:
+            self.images += 1
+            self.inference_seconds += elapsed
+        return result
+
+    def masks(self, images):
+        # alpha masks for a list of rgb images, in as few onnx runs as the
+        # model allows. blocking, meant for the executor like remove()
+        if not images:
+            return []
+        session = self._sessions.get()
+        try:
+            began = time.perf_counter()
+            params = BATCH_MODELS.get(self.model_name)
+            if params is None:
+                masks = [session.predict(image)[0] for image in images]
+            else:
+                masks = predict_batch(session, images, *params)
+            elapsed = time.perf_counter() - began
+        finally:
+            self._sessions.put(session)
+        with self._lock:
+            self.images += len(images)
+            self.inference_seconds += elapsed
+        return masks
+
+    async def run(self, func, *args):
+        # func(*args) on the inference executor, func calls self.remove()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "model": self.model_name,
+                "sessions": self.size,
+                "threads_per_session": self.threads,
+                "load_seconds": round(self.load_seconds, 3) if self.load_seconds is not None else None,
+                "images": self.images,
+                "avg_inference_seconds": round(self.inference_seconds / self.images, 3) if self.images else None,
+            }
@@ -3,13 +3,35 @@
 
 import os
 import uuid
+import importlib.util
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from PIL import Image
-from rembg import remove
 
-app = FastAPI(title="Background Remover API")
+
+def load_session_pool():
+    # shared with the bg remover api, which lives in a folder with a space in its name
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bg remover", "session_pool.py")
+    spec = importlib.util.spec_from_file_location("bg_remover_session_pool", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# the model is loaded and warmed up once, before the first request
+sessions = load_session_pool().RembgSessionPool()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sessions.start()
+    yield
+    sessions.shutdown()
+
+
+app = FastAPI(title="Background Remover API", lifespan=lifespan)
 
 os.makedirs("uploaded_images", exist_ok=True)
 os.makedirs("whitebg_added-images", exist_ok=True)
@@ -22,6 +44,24 @@ def is_valid_image(filename: str) -> bool:
     
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
+
+def white_background_file(upload_path, output_path):
+    # runs on the inference executor
+    with Image.open(upload_path) as input_img:
+        output_img = sessions.remove(input_img)
+
+    output_img = output_img.convert("RGBA")
+
+    white_bg = Image.new("RGBA", output_img.size, (255, 255, 255, 255))
+
+    final_img = Image.alpha_composite(white_bg, output_img).convert("RGB")
+    final_img.save(output_path, "JPEG")
+
+
+@app.get("/metrics")
+async def metrics():
+    return sessions.stats()
+
 @app.post("/white-background")
 async def remove_background(file: UploadFile = File(...)):
 
@@ -44,18 +84,9 @@ async def remove_background(file: UploadFile = File(...)):
         with open(upload_path, "wb") as buffer:
             buffer.write(await file.read())
         
-        input_img = Image.open(upload_path)
-        output_img = remove(input_img)
-
-        output_img = output_img.convert("RGBA")
-
-        white_bg = Image.new("RGBA", output_img.size, (255, 255, 255, 255))
-
-        final_img = Image.alpha_composite(white_bg, output_img).convert("RGB")
-
         output_filename = f"{unique_id}.jpg"
         output_path = os.path.join("whitebg_added-images", output_filename)
-        final_img.save(output_path, "JPEG")
+        await sessions.run(white_background_file, upload_path, output_path)
 
         download_link = f"http://127.0.0.1:8000/files/{output_filename}"
         
@@ -0,0 +1,112 @@
+
+# content addressed cache of compressed outputs
+
+import os
+import json
+import threading
+from collections import OrderedDict
+
+
+def summarize(stats):
+    # the stats kept in the index: everything but the per-image details, which
+    # for a big document would make every index write megabytes
+    if "images" not in stats:
+        return stats
+    images = {key: value for key, value in stats["images"].items() if key != "details"}
+    return {**stats, "images": images}
+
+
+class ResultCache:
+    # key -> {"filename", "size", "stats"}, the file itself lives in `directory`.
+    # entries are kept in LRU order and the least recently used ones (and their
+    # files) are dropped once either the entry or byte limit is exceeded.
+    # put() writes the index file, call it from a thread rather than the event loop
+
+    def __init__(self, directory, index_path, max_entries=1000, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.index_path = index_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # one index write at a time, so an older snapshot never lands last
+        self._save_lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(digest, quality_level, engine_version):
+        return f"{digest}:{quality_level}:{engine_version}"
+
+    @property
+    def total_bytes(self):
+        return sum(entry["size"] for entry in self._entries.values())
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        try:
+            with open(self.index_path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        for key, entry in entries:
+            if os.path.exists(os.path.join(self.directory, entry["filename"])):
+                self._entries[key] = entry
+
+    def _save(self):
+        # the snapshot is taken under the entry lock, the write happens outside it
+        # so lookups are not held up by the disk
+        with self._save_lock:
+            with self._lock:
+                entries = list(self._entries.items())
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entries, f)
+            os.replace(tmp_path, self.index_path)
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            path = os.path.join(self.directory, entry["filename"])
+            if os.path.exists(path):
+                os.remove(path)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not os.path.exists(os.path.join(self.directory, entry["filename"])):
+                # the file was removed behind our back
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, filename, stats):
+        size = os.path.getsize(os.path.join(self.directory, filename))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._entries[key] = {"filename": filename, "size": size, "stats": summarize(stats)}
+            self._entries.move_to_end(key)
+            self._evict()
+        self._save()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size": round(self.total_bytes / 1024, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,417 @@
+
+# compression engine used by the compress fastapi
+
+import os
+import io
+import hashlib
+import fitz
+
+try:
+    from PIL import Image
+except ImportError:  # JPEG2000 output needs Pillow built with openjpeg
+    Image = None
+
+try:
+    import pikepdf
+except ImportError:  # linearized output falls back to MuPDF, which dropped it in 1.26
+    pikepdf = None
+
+
+# bump whenever a change here alters the bytes we produce, cached results
+# from an older engine are then ignored
+ENGINE_VERSION = "4"
+
+# per-level presets: "save" goes straight to doc.save(), "images" drives the
+# raster pass (None = leave images untouched)
+COMPRESSION_PRESETS = {
+    "Maximum": {
+        "save": {"deflate": True, "garbage": 0, "clean": False, "pretty": False},
+        "images": None,
+    },
+    "High": {
+        "save": {"deflate": True, "garbage": 3, "clean": False, "pretty": False},
+        "images": {"dpi": 300, "quality": 85, "format": "jpeg"},
+    },
+    "Medium": {
+        "save": {"deflate": True, "garbage": 3, "clean": True, "pretty": False},
+        "images": {"dpi": 150, "quality": 75, "format": "jpeg"},
+    },
+    "Low": {
+        "save": {"deflate": True, "garbage": 4, "clean": True, "pretty": False},
+        "images": {"dpi": 110, "quality": 60, "format": "jpeg"},
+    },
+    "Minimum": {
+        "save": {"deflate": True, "garbage": 4, "clean": True, "pretty": False},
+        "images": {"dpi": 72, "quality": 45, "format": "jpeg"},
+    },
+}
+
+# images smaller than this (in pixels, either side) are not worth re-encoding
+MIN_IMAGE_SIDE = 64
+
+# documents are only split into shards of at least this many pages
+SHARD_MIN_PAGES = 50
+
+# only downsample when the image is at least this much above the target dpi
+DOWNSAMPLE_THRESHOLD = 1.1
+
+
+def normalize_quality(quality_level):
+    return quality_level if quality_level in COMPRESSION_PRESETS else "Medium"
+
+
+def get_preset(quality_level):
+    return COMPRESSION_PRESETS[normalize_quality(quality_level)]
+
+
+def _effective_dpi(page, xref, pix_width):
+    # highest dpi the image is drawn at on this page (smallest placement wins)
+    dpi = 0
+    for rect in page.get_image_rects(xref):
+        if rect.width > 0:
+            dpi = max(dpi, pix_width / (rect.width / 72))
+    return dpi
+
+
+def _encode_image(pix, quality, image_format):
+    if image_format == "jpx" and Image is not None:
+        mode = "L" if pix.n == 1 else "RGB"
+        img = Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+        buffer = io.BytesIO()
+        try:
+            # quality_layers is a compression ratio, map quality 0-100 onto it
+            img.save(buffer, "JPEG2000", quality_mode="rates", quality_layers=[max(1, (100 - quality) / 2)])
+            return buffer.getvalue(), "jpx"
+        except (OSError, KeyError):
+            pass
+    return pix.tobytes("jpeg", jpg_quality=quality), "jpeg"
+
+
+def _image_digest(doc, xref, raw):
+    # the dictionary (/Decode, /ColorSpace, /SMask, ...) changes how the same bytes
+    # render, so two images only match when both the stream and its settings do
+    digest = hashlib.sha256(raw)
+    digest.update(doc.xref_object(xref, compressed=True).encode())
+    return digest.hexdigest()
+
+
+def _replace_image(doc, page, xref, smask, new_stream):
+    # replace_image rewrites the whole image dictionary, hook the original soft
+    # mask back up or transparent areas render black. the mask keeps its own
+    # resolution, which the spec allows to differ from the image
+    page.replace_image(xref, stream=new_stream)
+    if smask:
+        doc.xref_set_key(xref, "SMask", f"{smask} 0 R")
+
+
+def compress_images(doc, image_params, pages=None, replaced=None):
+    # downsample / re-encode every raster image once, identical images share one encode.
+    # pages limits the pass to those page numbers, replaced collects every
+    # (page number, xref, smask, new stream) that was written
+    target_dpi = image_params["dpi"]
+    quality = image_params["quality"]
+    image_format = image_params.get("format", "jpeg")
+
+    done = {}          # xref -> result of the first encode
+    by_digest = {}     # stream + dictionary digest -> new stream bytes
+    details = []
+    duplicates = 0
+    skipped = 0
+
+    for page in (doc if pages is None else (doc[number] for number in pages)):
+        for img in page.get_images(full=True):
+            xref, smask, width, height, bpc = img[0], img[1], img[2], img[3], img[4]
+            if xref in done:
+                continue
+            done[xref] = True
+
+            if width < MIN_IMAGE_SIDE or height < MIN_IMAGE_SIDE or bpc == 1:
+                skipped += 1
+                continue
+
+            try:
+                raw = doc.xref_stream_raw(xref)
+                digest = _image_digest(doc, xref, raw)
+
+                if digest in by_digest:
+                    # same pixels as an image we already encoded, reuse the bytes so
+                    # garbage collection on save folds both objects into one
+                    new_stream = by_digest[digest]
+                    if new_stream is not None:
+                        _replace_image(doc, page, xref, smask, new_stream)
+                        if replaced is not None:
+                            replaced.append((page.number, xref, smask, new_stream))
+                    duplicates += 1
+                    continue
+                by_digest[digest] = None
+
+                pix = fitz.Pixmap(doc, xref)
+                if pix.colorspace is None or pix.colorspace.n not in (1, 3):
+                    pix = fitz.Pixmap(fitz.csRGB, pix)
+                if pix.alpha:
+                    pix = fitz.Pixmap(pix, 0)
+
+                original_dpi = _effective_dpi(page, xref, pix.width)
+                if original_dpi > target_dpi * DOWNSAMPLE_THRESHOLD:
+                    scale = target_dpi / original_dpi
+                    pix = fitz.Pixmap(pix, max(1, int(pix.width * scale)), max(1, int(pix.height * scale)), None)
+
+                new_stream, used_format = _encode_image(pix, quality, image_format)
+                if len(new_stream) >= len(raw):
+                    skipped += 1
+                    continue
+
+                _replace_image(doc, page, xref, smask, new_stream)
+                if replaced is not None:
+                    replaced.append((page.number, xref, smask, new_stream))
+                by_digest[digest] = new_stream
+                details.append({
+                    "xref": xref,
+                    "page": page.number + 1,
+                    "original_size": round(len(raw) / 1024, 2),
+                    "compressed_size": round(len(new_stream) / 1024, 2),
+                    "original_dpi": round(original_dpi),
+                    "format": used_format,
+                })
+            except Exception:
+                skipped += 1
+
+    saved = sum(d["original_size"] - d["compressed_size"] for d in details)
+    return {
+        "processed": len(details),
+        "duplicates": duplicates,
+        "skipped": skipped,
+        "saved_size": round(saved, 2),
+        "details": details,
+    }
+
+
+def _save(doc, output_path, save_params, linearize=False):
+    # returns whether the file on disk actually ended up linearized
+    if not linearize:
+        doc.save(output_path, **save_params)
+        return False
+
+    if pikepdf is not None:
+        tmp_path = f"{output_path}.tmp"
+        doc.save(tmp_path, **save_params)
+        try:
+            with pikepdf.open(tmp_path) as pdf:
+                pdf.save(output_path, linearize=True)
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    try:
+        doc.save(output_path, linear=True, **save_params)
+        return True
+    except Exception:
+        doc.save(output_path, **save_params)
+        return False
+
+
+def size_stats(input_path, output_path):
+    original_size = os.path.getsize(input_path)
+    compressed_size = os.path.getsize(output_path)
+    reduction = (1 - compressed_size / original_size) * 100
+
+    return {
+        "original_size": round(original_size / 1024, 2),
+        "compressed_size": round(compressed_size / 1024, 2),
+        "reduction_percentage": round(reduction, 2),
+    }
+
+
+def merge_image_stats(shard_stats):
+    merged = {"processed": 0, "duplicates": 0, "skipped": 0, "saved_size": 0, "details": []}
+    for stats in shard_stats:
+        for key in ("processed", "duplicates", "skipped", "saved_size"):
+            merged[key] += stats[key]
+        merged["details"].extend(stats["details"])
+    merged["saved_size"] = round(merged["saved_size"], 2)
+    return merged
+
+
+def _compress_file(input_path, output_path, save_params, image_params, linearize=False):
+    doc = fitz.open(input_path)
+    image_stats = None
+    if image_params is not None:
+        image_stats = compress_images(doc, image_params)
+    linearized = _save(doc, output_path, save_params, linearize)
+    doc.close()
+    return image_stats, linearized
+
+
+def compress_pdf_with_pymupdf(input_path, output_path, quality_level="Medium", linearize=False):
+    preset = get_preset(quality_level)
+    image_stats, linearized = _compress_file(input_path, output_path, preset["save"], preset["images"], linearize)
+
+    stats = size_stats(input_path, output_path)
+    stats["linearized"] = linearized
+    if image_stats is not None:
+        stats["images"] = image_stats
+    return stats
+
+
+# sharded mode: the image pass for each page range runs in its own worker process
+# and only the re-encoded streams come back. they are written into the original
+# document, which is saved once, so links, form fields and named destinations that
+# cross shard boundaries survive exactly as in the plain path
+
+def count_pages(input_path):
+    with fitz.open(input_path) as doc:
+        return len(doc)
+
+
+def plan_shards(page_count, max_shards):
+    # split [0, page_count) into at most max_shards contiguous (first, last) ranges
+    shards = max(1, min(max_shards, page_count // SHARD_MIN_PAGES))
+    size, extra = divmod(page_count, shards)
+    ranges = []
+    first = 0
+    for i in range(shards):
+        last = first + size + (1 if i < extra else 0) - 1
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+
+def compress_shard(input_path, first_page, last_page, quality_level="Medium"):
+    # returns (image stats, replaced images) for pages first_page..last_page
+    preset = get_preset(quality_level)
+    if preset["images"] is None:
+        return None, []
+
+    replaced = []
+    with fitz.open(input_path) as doc:
+        image_stats = compress_images(doc, preset["images"], range(first_page, last_page + 1), replaced)
+    return image_stats, replaced
+
+
+def assemble_shards(input_path, shard_images, output_path, quality_level="Medium", linearize=False):
+    preset = get_preset(quality_level)
+
+    doc = fitz.open(input_path)
+    written = set()
+    for replaced in shard_images:
+        for page_number, xref, smask, new_stream in replaced:
+            # an image used on pages of several shards was encoded by each, keep one
+            if xref in written:
+                continue
+            written.add(xref)
+            _replace_image(doc, doc[page_number], xref, smask, new_stream)
+
+    linearized = _save(doc, output_path, preset["save"], linearize)
+    doc.close()
+    return linearized
+
+
+# target size mode: walk a ladder of image settings, best looking first, and pick
+# the best rung whose output fits. rungs are estimated on a sample of pages first
+# so most of the search never pays for a full save, then the estimate is settled
+# with real saves
+
+TARGET_LADDER = [
+    {"dpi": 300, "quality": 85, "format": "jpeg"},
+    {"dpi": 200, "quality": 80, "format": "jpeg"},
+    {"dpi": 150, "quality": 75, "format": "jpeg"},
+    {"dpi": 150, "quality": 60, "format": "jpeg"},
+    {"dpi": 110, "quality": 60, "format": "jpeg"},
+    {"dpi": 96, "quality": 50, "format": "jpeg"},
+    {"dpi": 72, "quality": 45, "format": "jpeg"},
+    {"dpi": 72, "quality": 30, "format": "jpeg"},
+    {"dpi": 50, "quality": 25, "format": "jpeg"},
+]
+
+TARGET_SAVE = {"deflate": True, "garbage": 4, "clean": True, "pretty": False}
+
+# number of evenly spaced pages used to estimate the size of a rung
+TARGET_SAMPLE_PAGES = 8
+
+
+def _sample_pages(page_count):
+    if page_count <= TARGET_SAMPLE_PAGES:
+        return list(range(page_count))
+    step = page_count / TARGET_SAMPLE_PAGES
+    return [int(i * step) for i in range(TARGET_SAMPLE_PAGES)]
+
+
+def _sample_size(input_path, pages, page_count, image_params):
+    doc = fitz.open(input_path)
+    if len(pages) < page_count:
+        doc.select(pages)
+    compress_images(doc, image_params)
+    size = len(doc.tobytes(**TARGET_SAVE))
+    doc.close()
+    return size
+
+
+def _estimate_size(input_path, pages, page_count, image_params):
+    size = _sample_size(input_path, pages, page_count, image_params)
+    if len(pages) == page_count:
+        return size
+    # a one page save is the baseline: fixed overhead plus whatever the pages share
+    # (images, fonts), which the whole document carries only once. only what each
+    # further page adds is scaled up
+    baseline = _sample_size(input_path, pages[:1], page_count, image_params)
+    per_page = max(0, size - baseline) / (len(pages) - 1)
+    return baseline + per_page * (page_count - 1)
+
+
+def compress_to_target(input_path, output_path, target_size_kb, linearize=False):
+    target = target_size_kb * 1024
+    page_count = count_pages(input_path)
+    pages = _sample_pages(page_count)
+    last = len(TARGET_LADDER) - 1
+
+    # binary search for the first rung the sample says will fit; sizes shrink
+    # as we go down the ladder so the fitting rungs form a suffix of it
+    sampled = 0
+    low, high = 0, last
+    rung = last
+    while low <= high:
+        middle = (low + high) // 2
+        sampled += 1
+        if _estimate_size(input_path, pages, page_count, TARGET_LADDER[middle]) <= target:
+            rung = middle
+            high = middle - 1
+        else:
+            low = middle + 1
+
+    # the estimate can be off either way, settle it with real saves: a rung that
+    # fits bounds the answer from above, so look for better ones above it, one
+    # that doesn't sends the search below it. the neighbour of the estimate is the
+    # likeliest answer and is tried first, then the rest of the bracket is halved
+    trial_path = f"{output_path}.trial"
+    chosen = None
+    full = 0
+    probe = rung
+    low, high = 0, last
+    try:
+        while low <= high:
+            full += 1
+            trial_stats, trial_linearized = _compress_file(input_path, trial_path, TARGET_SAVE, TARGET_LADDER[probe], linearize)
+            fits = os.path.getsize(trial_path) <= target
+            # the last rung is kept as the fallback when nothing fits
+            if fits or (chosen is None and probe == last):
+                os.replace(trial_path, output_path)
+                chosen, image_stats, linearized = probe, trial_stats, trial_linearized
+            if fits:
+                high = probe - 1
+            else:
+                low = probe + 1
+            probe = (high if fits else low) if full == 1 else (low + high) // 2
+    finally:
+        if os.path.exists(trial_path):
+            os.remove(trial_path)
+
+    compressed_size = os.path.getsize(output_path)
+
+    stats = size_stats(input_path, output_path)
+    stats["linearized"] = linearized
+    stats["target_size"] = target_size_kb
+    stats["target_met"] = compressed_size <= target
+    stats["settings"] = {"dpi": TARGET_LADDER[chosen]["dpi"], "quality": TARGET_LADDER[chosen]["quality"]}
+    stats["trial_passes"] = {"sampled": sampled, "full": full}
+    stats["images"] = image_stats
+    return stats
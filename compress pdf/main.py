@@ -2,77 +2,141 @@
 # compress fastapi
 
 import os
-import fitz
+import sys
 import uuid
+import asyncio
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, Form
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 from typing import Optional
 
-app = FastAPI()
+from compressor import (
+    compress_pdf_with_pymupdf, normalize_quality, ENGINE_VERSION,
+    count_pages, plan_shards, compress_shard, assemble_shards, merge_image_stats, size_stats,
+    compress_to_target,
+)
+from pool import JobPool, PoolFullError
+from cache import ResultCache
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.transfer import spool_upload
+
+
+# worker processes, extra jobs allowed to wait, and seconds before a job is given up on
+COMPRESS_WORKERS = int(os.environ.get("COMPRESS_WORKERS", os.cpu_count() or 1))
+COMPRESS_QUEUE_SIZE = int(os.environ.get("COMPRESS_QUEUE_SIZE", COMPRESS_WORKERS * 4))
+COMPRESS_JOB_TIMEOUT = float(os.environ.get("COMPRESS_JOB_TIMEOUT", 300))
+
+compress_pool = JobPool(COMPRESS_WORKERS, COMPRESS_QUEUE_SIZE, COMPRESS_JOB_TIMEOUT)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    compress_pool.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 OUTPUT_DIRECTORY = os.path.join(BASE_DIR, "compressed_files")
+UPLOAD_DIRECTORY = os.path.join(BASE_DIR, "uploaded_pdfs")
 os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
-#
-os.makedirs("uploaded_pdfs", exist_ok=True)
-#
+os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+
+# repeat uploads of the same file at the same level are served from here
+result_cache = ResultCache(
+    OUTPUT_DIRECTORY,
+    os.path.join(BASE_DIR, "cache_index.json"),
+    max_entries=int(os.environ.get("COMPRESS_CACHE_MAX_ENTRIES", 1000)),
+    max_bytes=int(os.environ.get("COMPRESS_CACHE_MAX_MB", 1024)) * 1024 * 1024,
+)
+
 
 # Mount static directory
 
 app.mount("/files", StaticFiles(directory=OUTPUT_DIRECTORY), name="files")
 
-def compress_pdf_with_pymupdf(input_path, output_path, quality_level="Medium"):
-    quality_mapping = {
-        "Maximum": {"deflate": True, "garbage": 0, "clean": False, "pretty": False},
-        "High": {"deflate": True, "garbage": 1, "clean": False, "pretty": False},
-        "Medium": {"deflate": True, "garbage": 2, "clean": True, "pretty": False},
-        "Low": {"deflate": True, "garbage": 3, "clean": True, "pretty": False},
-        "Minimum": {"deflate": True, "garbage": 4, "clean": True, "pretty": False},
-    }
-    params = quality_mapping.get(quality_level, quality_mapping["Medium"])
-
-    doc = fitz.open(input_path)
-    doc.save(output_path, **params)
-    doc.close()
-
-    original_size = os.path.getsize(input_path)
-    compressed_size = os.path.getsize(output_path)
-    reduction = (1 - compressed_size / original_size) * 100
-
-    return {
-        "original_size": round(original_size / 1024, 2),
-        "compressed_size": round(compressed_size / 1024, 2),
-        "reduction_percentage": round(reduction, 2),
-    }
+
+async def compress_in_shards(input_path, output_path, quality_level, linearize):
+    # fan the image pass for each page range out over the pool, then save once in one more job
+    page_count = await compress_pool.run(count_pages, input_path)
+    shards = plan_shards(page_count, compress_pool.workers)
+    if len(shards) < 2:
+        return await compress_pool.run(compress_pdf_with_pymupdf, input_path, output_path, quality_level, linearize)
+
+    if not compress_pool.has_room(len(shards)):
+        raise PoolFullError("Server is busy, please retry shortly")
+
+    results = await asyncio.gather(*[
+        compress_pool.run(compress_shard, input_path, first, last, quality_level)
+        for first, last in shards
+    ])
+    image_stats = [stats for stats, _ in results]
+    shard_images = [replaced for _, replaced in results]
+    linearized = await compress_pool.run(assemble_shards, input_path, shard_images, output_path, quality_level, linearize)
+
+    stats = size_stats(input_path, output_path)
+    stats["linearized"] = linearized
+    stats["shards"] = len(shards)
+    if image_stats[0] is not None:
+        stats["images"] = merge_image_stats(image_stats)
+    return stats
+
 
 @app.post("/compress-pdf")
-async def compress_pdf(file: UploadFile = File(...), quality_level: Optional[str] = Form("Medium")):
+async def compress_pdf(
+    file: UploadFile = File(...),
+    quality_level: Optional[str] = Form("Medium"),
+    parallel: bool = Form(False),
+    linearize: bool = Form(False),
+    target_size_kb: Optional[int] = Form(None),
+):
     if not file.filename.endswith(".pdf"):
         return JSONResponse(status_code=400, content={"status": "error", "message": "Only PDF files are allowed"})
 
+    if target_size_kb is not None and target_size_kb <= 0:
+        return JSONResponse(status_code=400, content={"status": "error", "message": "target_size_kb must be a positive number"})
+
    
     os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
 
-    temp_file = os.path.join(OUTPUT_DIRECTORY, f"temp_{file.filename}")
+    # reject before touching the disk when there is no room for another job
+    if compress_pool.is_full:
+        return JSONResponse(status_code=429, content={"status": "error", "message": "Server is busy, please retry shortly"})
 
     try:
 
-        with open(temp_file, "wb") as f:
-            content = await file.read()
-            f.write(content)
-
-        output_filename = f"{uuid.uuid4()}.pdf"
-        output_path = os.path.join(OUTPUT_DIRECTORY, output_filename)
-
-        #
-        upload_path = os.path.join("uploaded_pdfs", f"{uuid.uuid4()}.pdf")
-        with open(upload_path, "wb") as buffer:
-            buffer.write(await file.read())
-        #
-
-        compression_stats = compress_pdf_with_pymupdf(temp_file, output_path, quality_level)
-        os.remove(temp_file)
+        # the archived upload is spooled once and is also the compressor input
+        upload_path = os.path.join(UPLOAD_DIRECTORY, f"{uuid.uuid4()}.pdf")
+        digest, _ = await spool_upload(file, upload_path)
+
+        quality_level = normalize_quality(quality_level)
+        # a target size replaces the quality level as far as the output is concerned
+        cache_variant = f"target{target_size_kb}" if target_size_kb else quality_level
+        if linearize:
+            cache_variant += "+linear"
+        if parallel and not target_size_kb:
+            cache_variant += "+parallel"
+        cache_key = ResultCache.make_key(digest, cache_variant, ENGINE_VERSION)
+        cached = result_cache.get(cache_key)
+
+        if cached is not None:
+            output_filename = cached["filename"]
+            compression_stats = cached["stats"]
+        else:
+            output_filename = f"{uuid.uuid4()}.pdf"
+            output_path = os.path.join(OUTPUT_DIRECTORY, output_filename)
+
+            if target_size_kb:
+                compression_stats = await compress_pool.run(compress_to_target, upload_path, output_path, target_size_kb, linearize)
+            elif parallel:
+                compression_stats = await compress_in_shards(upload_path, output_path, quality_level, linearize)
+            else:
+                compression_stats = await compress_pool.run(compress_pdf_with_pymupdf, upload_path, output_path, quality_level, linearize)
+            await asyncio.get_running_loop().run_in_executor(None, result_cache.put, cache_key, output_filename, compression_stats)
 
         base_url = "http://127.0.0.1:8000"
         download_link = f"{base_url}/files/{output_filename}"
@@ -87,9 +151,17 @@ async def compress_pdf(file: UploadFile = File(...), quality_level: Optional[str
             },
         )
 
+    except PoolFullError as e:
+        return JSONResponse(status_code=429, content={"status": "error", "message": str(e)})
+    except asyncio.TimeoutError:
+        return JSONResponse(status_code=504, content={"status": "error", "message": "Compression took too long"})
     except Exception as e:
         return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
 
+@app.get("/cache-stats")
+async def cache_stats():
+    return result_cache.stats()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,73 @@
+
+# bounded process pool so PyMuPDF work never runs on the event loop
+
+import os
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class PoolFullError(Exception):
+    pass
+
+
+class JobPool:
+    # at most `workers` jobs run at once and `queue_size` more may wait,
+    # anything past that is rejected straight away instead of piling up
+
+    def __init__(self, workers=None, queue_size=None, timeout=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue_size = self.workers * 4 if queue_size is None else queue_size
+        self.timeout = timeout
+        self.pending = 0
+        self._executor = None
+
+    @property
+    def is_full(self):
+        return not self.has_room(1)
+
+    def has_room(self, jobs):
+        return self.pending + jobs <= self.workers + self.queue_size
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def _release(self):
+        self.pending -= 1
+
+    def _job_done(self, loop):
+        # runs on the executor's thread, hand the bookkeeping back to the loop
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            pass  # loop already closed during shutdown
+
+    async def run(self, func, *args, timeout=None):
+        if self.is_full:
+            raise PoolFullError("Server is busy, please retry shortly")
+
+        self.pending += 1
+        try:
+            try:
+                job = self._get_executor().submit(func, *args)
+            except BrokenProcessPool:
+                # a worker died (e.g. killed by the OOM killer), start a fresh pool
+                self._executor = None
+                job = self._get_executor().submit(func, *args)
+        except Exception:
+            self.pending -= 1
+            raise
+
+        # the slot is only freed once the worker is really done with the job,
+        # a timed out job keeps its slot until the process gets to the end of it
+        loop = asyncio.get_running_loop()
+        job.add_done_callback(lambda _: self._job_done(loop))
+
+        return await asyncio.wait_for(asyncio.wrap_future(job), timeout or self.timeout)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
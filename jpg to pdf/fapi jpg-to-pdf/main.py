@@ -1,16 +1,26 @@
 
 # this is the jpg to pdf conversion fastapi
 
+import io
 import os
 import uuid
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
+from typing import List
 
-from PIL import Image
-from fastapi import FastAPI, UploadFile, File
+from fastapi import FastAPI, UploadFile, File, Form
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 
+from normalize import (
+    DEFAULT_QUALITY, EXTENSIONS, PAGE_SIZES, UnsupportedImage,
+    normalize_many, orient_page,
+)
+from pdfstream import NotAJpeg, StreamingPdfWriter, jpeg_info
+
 
 BASE_DIR   = Path(__file__).resolve().parent
 INPUT_DIR  = BASE_DIR / "input"
@@ -18,7 +28,19 @@ OUTPUT_DIR = BASE_DIR / "output"
 INPUT_DIR.mkdir(exist_ok=True)
 OUTPUT_DIR.mkdir(exist_ok=True)
 
-app = FastAPI()
+# images decoded / scaled / encoded at once, and how many may wait for the writer
+NORMALIZE_WORKERS = int(os.environ.get("NORMALIZE_WORKERS", os.cpu_count() or 1))
+NORMALIZE_WINDOW = NORMALIZE_WORKERS * 2
+normalize_executor = ThreadPoolExecutor(max_workers=NORMALIZE_WORKERS)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    normalize_executor.shutdown(cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 app.mount("/files", StaticFiles(directory=OUTPUT_DIR), name="files")
@@ -31,12 +53,12 @@ async def convert_jpg_to_pdf(file: UploadFile = File(...)):
 
     orig_name = file.filename
     _, ext = os.path.splitext(orig_name)
-    if ext.lower() not in (".jpg", ".jpeg"):
+    if ext.lower() not in EXTENSIONS:
         return JSONResponse(
             status_code=400,
             content={
                 "status":  "error",
-                "message": "jpg format images only"
+                "message": f"{', '.join(EXTENSIONS)} images only"
             }
         )
 
@@ -44,13 +66,22 @@ async def convert_jpg_to_pdf(file: UploadFile = File(...)):
     input_path  = INPUT_DIR  / f"{unique_id}{ext.lower()}"
     output_path = OUTPUT_DIR / f"{unique_id}.pdf"
 
-    with input_path.open("wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # keep a copy of the upload, the pdf is still built from its spool file
+    await run_in_threadpool(archive_upload, file, input_path)
 
     try:
-        image = Image.open(input_path)
-        image.convert("RGB").save(output_path, "PDF")
+        await run_in_threadpool(build_pdf, [file], output_path, 72)
+    except (NotAJpeg, UnsupportedImage) as exc:
+        output_path.unlink(missing_ok=True)
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status":  "error",
+                "message": str(exc)
+            }
+        )
     except Exception as exc:                  
+        output_path.unlink(missing_ok=True)
         return JSONResponse(
             status_code=500,
             content={
@@ -65,3 +96,112 @@ async def convert_jpg_to_pdf(file: UploadFile = File(...)):
         "message":       "jpg file convertedn into pdf successfully!",
         "download_link": download_link
     }
+
+
+def archive_upload(upload, input_path):
+    upload.file.seek(0)
+    with input_path.open("wb") as buffer:
+        shutil.copyfileobj(upload.file, buffer)
+
+
+def build_pdf(files, output_path, dpi, page_size=None, max_dpi=None, quality=DEFAULT_QUALITY):
+    # one page per image, in upload order. the images are normalized on the
+    # pool a few ahead of the writer; jpegs that need no change are copied
+    # into the pdf straight from the uploads' spool files
+    normalized = normalize_many(
+        normalize_executor, (upload.file for upload in files), NORMALIZE_WINDOW,
+        page_size=page_size, max_dpi=max_dpi, quality=quality,
+    )
+    with StreamingPdfWriter(output_path) as writer:
+        for upload in files:
+            try:
+                data = next(normalized)
+                source = upload.file if data is None else io.BytesIO(data)
+                info = jpeg_info(source)
+            except (NotAJpeg, UnsupportedImage) as exc:
+                raise type(exc)(f"{upload.filename}: {exc}")
+            page = orient_page(page_size, info[0], info[1]) if page_size else None
+            writer.add_jpeg(source, dpi=dpi, page_size=page, info=info)
+        return writer.page_count
+
+
+@app.post("/convert-jpg-to-pdf/batch")
+async def convert_jpgs_to_pdf(
+    files: List[UploadFile] = File(...),
+    dpi: int = Form(72),
+    page_size: str = Form(""),
+    max_dpi: int = Form(0),
+    quality: int = Form(DEFAULT_QUALITY)
+):
+
+    # page_size "a4" / "letter" fits every image on a page of that size,
+    # turned to match the image, and max_dpi (with a page size) scales images
+    # down to what that page needs. quality is used for the images that have
+    # to be re-encoded (rotated, converted or scaled down)
+
+    #  Validate extensions and options before touching any of the images
+
+    for file in files:
+        _, ext = os.path.splitext(file.filename)
+        if ext.lower() not in EXTENSIONS:
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "status":  "error",
+                    "message": f"{', '.join(EXTENSIONS)} images only ({file.filename})"
+                }
+            )
+    error = None
+    if not 1 <= dpi <= 2400:
+        error = "dpi must be between 1 and 2400"
+    elif page_size and page_size.lower() not in PAGE_SIZES:
+        error = f"page_size must be one of: {', '.join(PAGE_SIZES)}"
+    elif max_dpi and not 18 <= max_dpi <= 2400:
+        error = "max_dpi must be 0 (keep full size) or between 18 and 2400"
+    elif max_dpi and not page_size:
+        error = "max_dpi needs a page_size"
+    elif not 1 <= quality <= 100:
+        error = "quality must be between 1 and 100"
+    if error:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status":  "error",
+                "message": error
+            }
+        )
+
+    unique_id   = str(uuid.uuid4())
+    output_path = OUTPUT_DIR / f"{unique_id}.pdf"
+
+    try:
+        pages = await run_in_threadpool(
+            build_pdf, files, output_path, dpi,
+            PAGE_SIZES.get(page_size.lower()), max_dpi or None, quality
+        )
+    except (NotAJpeg, UnsupportedImage) as exc:
+        output_path.unlink(missing_ok=True)
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status":  "error",
+                "message": str(exc)
+            }
+        )
+    except Exception:
+        output_path.unlink(missing_ok=True)
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status":  "error",
+                "message": "internal conversion error"
+            }
+        )
+    download_link = f"http://127.0.0.1:8000/files/{output_path.name}"
+
+    return {
+        "status":        "success",
+        "message":       f"{pages} jpg files converted into one pdf successfully!",
+        "pages":         pages,
+        "download_link": download_link
+    }
@@ -0,0 +1,141 @@
+
+# image normalization for the jpg to pdf fastapi
+#
+# phone photos rarely go into a pdf as they are: they carry an exif rotation,
+# come as cmyk, 16-bit or transparent pngs, or heic, and are far bigger than a
+# printed page needs. normalize_image() turns any of them into a jpeg the pdf
+# writer can embed, or returns None when the original jpeg can go in untouched.
+# pillow decodes, resizes and encodes with the gil released, so a thread pool
+# (normalize_many) spreads a batch over the cores.
+
+import io
+import math
+from collections import deque
+
+from PIL import Image, ImageOps
+
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except ImportError:
+    pillow_heif = None
+
+
+EXTENSIONS = (".jpg", ".jpeg", ".png") + ((".heic", ".heif") if pillow_heif else ())
+
+# portrait sizes in points, turned to landscape for landscape images
+PAGE_SIZES = {
+    "a4": (595.28, 841.89),
+    "letter": (612.0, 792.0),
+}
+
+DEFAULT_QUALITY = 90
+
+# exif orientations 5 to 8 swap width and height
+ORIENTATION_TAG = 0x0112
+TRANSPOSED = (5, 6, 7, 8)
+
+
+class UnsupportedImage(ValueError):
+    pass
+
+
+def orient_page(page_size, width, height):
+    # the page turned the same way as the image
+    page_width, page_height = page_size
+    if (width > height) != (page_width > page_height):
+        return page_height, page_width
+    return page_width, page_height
+
+
+def target_size(width, height, page_size, max_dpi):
+    # the most pixels the image needs once fitted on the page at max_dpi, or
+    # None when it is already small enough. width and height are as displayed
+    if page_size is None or not max_dpi:
+        return None
+    page_width, page_height = orient_page(page_size, width, height)
+    scale = min(page_width / width, page_height / height) * max_dpi / 72
+    if scale >= 1:
+        return None
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+
+def to_page_mode(image):
+    # pdf pages get gray or rgb, whatever the image came as
+    if image.mode in ("L", "RGB"):
+        return image
+    if image.mode.startswith("I;16") or image.mode == "I":
+        # 16-bit gray, keep the top 8 bits instead of clipping at 255
+        return image.convert("I").point(lambda value: value * (1 / 256)).convert("L")
+    if image.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in image.info:
+        # transparent areas come out white, like on paper
+        rgba = image.convert("RGBA")
+        background = Image.new("RGB", rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel("A"))
+        return background
+    if image.mode == "1":
+        return image.convert("L")
+    return image.convert("RGB")
+
+
+def normalize_image(fileobj, page_size=None, max_dpi=None, quality=DEFAULT_QUALITY):
+    # jpeg bytes ready for the pdf, or None if fileobj is a jpeg that can be
+    # embedded as it is (upright, gray / rgb / cmyk, not bigger than needed).
+    # leaves fileobj at the start
+    fileobj.seek(0)
+    try:
+        image = Image.open(fileobj)
+    except Exception:
+        raise UnsupportedImage("not a readable image")
+
+    try:
+        with image:
+            orientation = image.getexif().get(ORIENTATION_TAG, 1)
+            width, height = image.size
+            if orientation in TRANSPOSED:
+                width, height = height, width
+            size = target_size(width, height, page_size, max_dpi)
+
+            if image.format == "JPEG" and orientation == 1 and size is None \
+                    and image.mode in ("L", "RGB", "CMYK"):
+                return None
+
+            if size is not None:
+                # jpeg only: let libjpeg decode at 1/2, 1/4 or 1/8 scale, never
+                # below the size asked for. a no-op for the other formats
+                stored = (size[1], size[0]) if orientation in TRANSPOSED else size
+                image.draft(None, stored)
+
+            try:
+                image.load()
+            except Exception:
+                raise UnsupportedImage("image data is damaged")
+
+            image = ImageOps.exif_transpose(image)
+            image = to_page_mode(image)
+            if size is not None:
+                image.thumbnail(size, Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=quality)
+            return buffer.getvalue()
+    finally:
+        fileobj.seek(0)
+
+
+def normalize_many(executor, fileobjs, window, **options):
+    # normalize_image() over fileobjs on the executor, results in order. at
+    # most `window` images are in flight, so a large batch doesn't pile up
+    # decoded images faster than the writer takes them
+    pending = deque()
+    fileobjs = iter(fileobjs)
+    try:
+        for fileobj in fileobjs:
+            pending.append(executor.submit(normalize_image, fileobj, **options))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,150 @@
+
+# streaming pdf writer for the jpg to pdf fastapi
+#
+# jpeg files go into the pdf as they are: the compressed bytes become a
+# /DCTDecode image stream, nothing is decoded or encoded again. objects are
+# written one after another straight to the output file and only their offsets
+# are kept, so memory stays flat however many images go in. the page tree is
+# written last, once all the pages are known.
+
+import shutil
+
+from PIL import Image
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# object 1 is the catalog, object 2 the page tree, pages start at 3
+CATALOG = 1
+PAGES = 2
+
+# pdf's default user space unit, 72 per inch
+POINTS_PER_INCH = 72
+
+
+class NotAJpeg(ValueError):
+    pass
+
+
+def jpeg_info(fileobj):
+    # (width, height, color space, decode array) from the jpeg header only,
+    # the pixels are never decoded. leaves fileobj at the start
+    fileobj.seek(0)
+    try:
+        with Image.open(fileobj) as image:
+            if image.format != "JPEG":
+                raise NotAJpeg(f"not a jpeg image ({image.format})")
+            width, height = image.size
+            mode = image.mode
+            adobe = "adobe" in image.info
+    except NotAJpeg:
+        raise
+    except Exception:
+        raise NotAJpeg("not a readable image")
+    finally:
+        fileobj.seek(0)
+
+    if mode == "L":
+        return width, height, "/DeviceGray", None
+    if mode == "RGB":
+        return width, height, "/DeviceRGB", None
+    if mode == "CMYK":
+        # photoshop writes inverted cmyk (and flags it with an adobe marker)
+        return width, height, "/DeviceCMYK", "[1 0 1 0 1 0 1 0]" if adobe else None
+    raise NotAJpeg(f"unsupported jpeg color mode {mode}")
+
+
+class StreamingPdfWriter:
+
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._offsets = {}
+        self._pages = []
+        self._next = PAGES + 1
+        # the binary comment tells tools the file isn't plain text
+        self._file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    @property
+    def page_count(self):
+        return len(self._pages)
+
+    def _begin(self, number):
+        self._offsets[number] = self._file.tell()
+        self._file.write(b"%d 0 obj\n" % number)
+
+    def _object(self, number, body):
+        self._begin(number)
+        self._file.write(body.encode("latin-1") + b"\nendobj\n")
+
+    def _allocate(self, count):
+        first = self._next
+        self._next += count
+        return range(first, first + count)
+
+    def add_jpeg(self, fileobj, dpi=POINTS_PER_INCH, page_size=None, info=None):
+        # one page showing the jpeg in fileobj. the page is the image at `dpi`,
+        # or page_size (width, height in points) with the image centred and
+        # scaled to fit. `info` is jpeg_info(fileobj) if the caller has it
+        width, height, color_space, decode = info or jpeg_info(fileobj)
+        image, content, page = self._allocate(3)
+
+        # image xobject, the jpeg bytes copied through in chunks
+        fileobj.seek(0, 2)
+        length = fileobj.tell()
+        fileobj.seek(0)
+        extra = f" /Decode {decode}" if decode else ""
+        self._begin(image)
+        self._file.write((
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height}"
+            f" /ColorSpace {color_space} /BitsPerComponent 8{extra}"
+            f" /Filter /DCTDecode /Length {length} >>\nstream\n"
+        ).encode("latin-1"))
+        shutil.copyfileobj(fileobj, self._file, COPY_CHUNK_SIZE)
+        self._file.write(b"\nendstream\nendobj\n")
+
+        image_width = width * POINTS_PER_INCH / dpi
+        image_height = height * POINTS_PER_INCH / dpi
+        if page_size is None:
+            page_width, page_height = image_width, image_height
+            x = y = 0
+        else:
+            page_width, page_height = page_size
+            scale = min(page_width / image_width, page_height / image_height)
+            image_width, image_height = image_width * scale, image_height * scale
+            x, y = (page_width - image_width) / 2, (page_height - image_height) / 2
+
+        stream = f"q {image_width:.4f} 0 0 {image_height:.4f} {x:.4f} {y:.4f} cm /Im0 Do Q"
+        self._object(content, f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        self._object(page, (
+            f"<< /Type /Page /Parent {PAGES} 0 R /MediaBox [0 0 {page_width:.4f} {page_height:.4f}]"
+            f" /Resources << /XObject << /Im0 {image} 0 R >> >> /Contents {content} 0 R >>"
+        ))
+        self._pages.append(page)
+
+    def close(self):
+        kids = " ".join(f"{page} 0 R" for page in self._pages)
+        self._object(PAGES, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>")
+        self._object(CATALOG, f"<< /Type /Catalog /Pages {PAGES} 0 R >>")
+
+        xref_offset = self._file.tell()
+        size = self._next
+        self._file.write(b"xref\n0 %d\n" % size)
+        self._file.write(b"0000000000 65535 f \n")
+        for number in range(1, size):
+            self._file.write(b"%010d 00000 n \n" % self._offsets[number])
+        self._file.write(
+            b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, CATALOG, xref_offset)
+        )
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -0,0 +1,130 @@
+
+# benchmark for the merge backends in engine.py
+#
+# generates synthetic PDFs (text heavy and image heavy, any page count), merges
+# them with every backend and prints pages/sec and peak RSS for each run.
+# --repeat merges the inputs several times over, the output size then shows how
+# well each backend writes content the inputs share only once.
+#
+#   python benchmark.py --pages 1 100 1000 10000 --kinds text image --files 10
+#   python benchmark.py --pages 1000 --kinds image --repeat 3
+
+import os
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+import fitz
+
+try:
+    import resource
+except ImportError:  # unix only, on windows the peak RSS column is left empty
+    resource = None
+
+from engine import available_backends, get_backend
+
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud "
+    "exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. "
+)
+
+
+def make_text_page(doc, number):
+    page = doc.new_page()
+    text = f"Page {number}\n\n" + LOREM * 12
+    page.insert_textbox(fitz.Rect(50, 50, page.rect.width - 50, page.rect.height - 50), text, fontsize=10)
+
+
+def make_image_page(doc, number, rng):
+    page = doc.new_page()
+    width, height = 400, 300
+    samples = bytes(rng.getrandbits(8) for _ in range(width * height * 3 // 16)) * 16
+    pix = fitz.Pixmap(fitz.csRGB, width, height, samples, 0)
+    page.insert_image(fitz.Rect(50, 50, 550, 425), stream=pix.tobytes("jpeg", jpg_quality=80))
+    page.insert_text((50, 460), f"Page {number}", fontsize=12)
+
+
+def generate_inputs(directory, kind, total_pages, files):
+    # split total_pages over `files` documents, reusing them between runs
+    rng = random.Random(total_pages)
+    files = max(1, min(files, total_pages))
+    per_file, extra = divmod(total_pages, files)
+    paths = []
+    number = 1
+    for index in range(files):
+        path = os.path.join(directory, f"{kind}_{total_pages}_{index}.pdf")
+        pages = per_file + (1 if index < extra else 0)
+        if not os.path.exists(path):
+            doc = fitz.open()
+            for _ in range(pages):
+                if kind == "image":
+                    make_image_page(doc, number, rng)
+                else:
+                    make_text_page(doc, number)
+                number += 1
+            doc.save(path, garbage=3, deflate=True)
+            doc.close()
+        else:
+            number += pages
+        paths.append(path)
+    return paths
+
+
+def _run_backend(backend_name, paths, output_path, results):
+    # runs in a fresh process so ru_maxrss only reflects this merge
+    start = time.perf_counter()
+    pages = get_backend(backend_name).merge(paths, output_path)
+    elapsed = time.perf_counter() - start
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else None
+    results.put((pages, elapsed, peak_rss_kb))
+
+
+def run_backend(backend_name, paths, output_path):
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_backend, args=(backend_name, paths, output_path, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"{backend_name} merge failed with exit code {process.exitcode}")
+    return results.get()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PDF merge backends")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 100, 1000], help="total pages per run")
+    parser.add_argument("--kinds", nargs="+", default=["text", "image"], choices=["text", "image"])
+    parser.add_argument("--files", type=int, default=10, help="number of input files the pages are split into")
+    parser.add_argument("--repeat", type=int, default=1, help="merge the inputs this many times over")
+    parser.add_argument("--backends", nargs="+", default=available_backends(), choices=available_backends())
+    parser.add_argument("--workdir", default=None, help="where to keep the generated inputs (default: temp dir)")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="merge_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"inputs in {workdir}\n")
+
+    header = f"{'backend':<10}{'kind':<8}{'pages':>8}{'files':>7}{'seconds':>10}{'pages/s':>11}{'peak RSS MB':>13}{'output MB':>11}"
+    print(header)
+    print("-" * len(header))
+
+    for kind in args.kinds:
+        for total_pages in args.pages:
+            paths = generate_inputs(workdir, kind, total_pages, args.files) * max(1, args.repeat)
+            for backend_name in args.backends:
+                output_path = os.path.join(workdir, f"merged_{backend_name}_{kind}_{total_pages}.pdf")
+                pages, elapsed, peak_rss_kb = run_backend(backend_name, paths, output_path)
+                output_mb = os.path.getsize(output_path) / (1024 * 1024)
+                os.remove(output_path)
+                peak_rss = f"{peak_rss_kb / 1024:.1f}" if peak_rss_kb is not None else "n/a"
+                print(
+                    f"{backend_name:<10}{kind:<8}{pages:>8}{len(paths):>7}{elapsed:>10.2f}"
+                    f"{pages / elapsed:>11.1f}{peak_rss:>13}{output_mb:>11.2f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
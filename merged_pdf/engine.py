@@ -0,0 +1,554 @@
+
+# streaming merge engine for the merge fastapi
+
+# both backends keep each input's bookmarks, shifted to where its pages land in
+# the output, under one top-level bookmark per input file, and its named
+# destinations. a name an earlier input already used gets a per-input prefix
+# ("f2_intro").
+
+# two backends are available behind the same interface: "pypdf" is the streaming
+# merger below, "pymupdf" uses MuPDF's insert_pdf which is much faster on big
+# documents but keeps the whole output in memory until it is saved.
+
+# pages are copied object by object straight into the output file, so only the
+# input that is currently being appended is held in memory. objects are hashed
+# together with everything they point at, so identical images, fonts, colour
+# profiles etc. are written once no matter how many inputs carry them.
+
+import os
+import hashlib
+from pypdf import PdfReader
+from pypdf.errors import DependencyError
+from pypdf.generic import (
+    ArrayObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    TextStringObject,
+)
+
+try:
+    import fitz
+except ImportError:  # the pymupdf backend is only offered when PyMuPDF is installed
+    fitz = None
+
+
+CATALOG_ID = 1
+PAGES_ID = 2
+
+
+# objects under these types are tied to one spot in one document and never shared
+UNSHARED_TYPES = {"/Page", "/Pages", "/Catalog", "/Annot", "/Outlines"}
+
+
+class StreamingPdfMerger:
+
+    def __init__(self, output_path):
+        self.output = open(output_path, "wb")
+        self.output.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self.offsets = {}
+        self.next_id = PAGES_ID + 1
+        self.page_ids = []
+        self.shared = {}
+        self.deduplicated = 0
+        self.outline = []
+        self.named_dests = {}
+        self.inputs = 0
+
+        # per input state, reset by append()
+        self._mapping = {}
+        self._digests = {}
+        self._pending = []
+        self._renames = {}
+
+    def _allocate(self):
+        new_id = self.next_id
+        self.next_id += 1
+        return new_id
+
+    def _reference(self, ref):
+        key = (ref.idnum, ref.generation)
+        if key in self._mapping:
+            return self._mapping[key]
+
+        obj = ref.get_object()
+        if obj is None:
+            obj = NullObject()  # dangling reference in the input
+
+        try:
+            digest = self._digest(ref, set())
+        except RecursionError:
+            digest = None
+        if digest is not None and digest in self.shared:
+            self._mapping[key] = self.shared[digest]
+            self.deduplicated += 1
+            return self._mapping[key]
+
+        new_id = self._allocate()
+        if digest is not None:
+            self.shared[digest] = new_id
+        self._mapping[key] = new_id
+        self._pending.append((obj, new_id))
+        return new_id
+
+    def _rename_dest(self, value):
+        # a named destination this input shares with an earlier one was renamed,
+        # point the reference at the new name (names stay names, strings stay strings)
+        if isinstance(value, NameObject):
+            new_name = self._renames.get(value[1:], self._renames.get(value))
+            return value if new_name is None else NameObject("/" + new_name)
+        if isinstance(value, str) and value in self._renames:
+            return TextStringObject(self._renames[value])
+        return value
+
+    def _is_dest_key(self, obj, key):
+        return key == "/Dest" or (key == "/D" and obj.get("/S") == "/GoTo")
+
+    def _digest(self, obj, visiting):
+        # content hash of obj and everything reachable from it, None when the
+        # graph loops or reaches a page (those copies must stay separate)
+        if isinstance(obj, IndirectObject):
+            key = (obj.idnum, obj.generation)
+            if key in self._digests:
+                return self._digests[key]
+            if key in visiting:
+                return None
+            visiting.add(key)
+            digest = self._digest(obj.get_object(), visiting)
+            visiting.discard(key)
+            self._digests[key] = digest
+            return digest
+
+        sha256 = hashlib.sha256(type(obj).__name__.encode())
+        if isinstance(obj, DictionaryObject):
+            if obj.get("/Type") in UNSHARED_TYPES:
+                return None
+            for key in sorted(obj.keys()):
+                if key == "/Length":
+                    continue
+                value = obj.raw_get(key)
+                if self._is_dest_key(obj, key):
+                    value = self._rename_dest(value)
+                digest = self._digest(value, visiting)
+                if digest is None:
+                    return None
+                sha256.update(key.encode())
+                sha256.update(digest)
+            if isinstance(obj, StreamObject):
+                sha256.update(obj._data)
+        elif isinstance(obj, ArrayObject):
+            for value in obj:
+                digest = self._digest(value, visiting)
+                if digest is None:
+                    return None
+                sha256.update(digest)
+        else:
+            sha256.update(repr(obj).encode())
+        return sha256.digest()
+
+    def _translate(self, obj):
+        # copy obj with every indirect reference renumbered into the output file
+        if isinstance(obj, IndirectObject):
+            return IndirectObject(self._reference(obj), 0, None)
+        if isinstance(obj, StreamObject):
+            new = StreamObject()
+            new._data = obj._data
+            for key, value in obj.items():
+                if key != "/Length":
+                    new[NameObject(key)] = self._translate(value)
+            return new
+        if isinstance(obj, DictionaryObject):
+            new = DictionaryObject()
+            for key, value in obj.items():
+                if self._is_dest_key(obj, key):
+                    value = self._rename_dest(value)
+                new[NameObject(key)] = self._translate(value)
+            return new
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self._translate(value) for value in obj)
+        return obj
+
+    def _write_object(self, obj_id, obj):
+        self.offsets[obj_id] = self.output.tell()
+        self.output.write(f"{obj_id} 0 obj\n".encode())
+        obj.write_to_stream(self.output)
+        self.output.write(b"\nendobj\n")
+
+    def _flush_pending(self):
+        while self._pending:
+            obj, obj_id = self._pending.pop()
+            self._write_object(obj_id, self._translate(obj))
+
+    def _explicit_dest(self, dest, page_lookup, page_ids):
+        # turn a pypdf Destination into [page_ref /Type args...] pointing at our copy
+        page = dest.raw_get("/Page")
+        if isinstance(page, DictionaryObject) and page.indirect_reference is not None:
+            page = page.indirect_reference
+        if isinstance(page, IndirectObject):
+            page_id = page_lookup.get((page.idnum, page.generation))
+        elif isinstance(page, int) and 0 <= page < len(page_ids):
+            page_id = page_ids[page]
+        else:
+            page_id = None
+        if page_id is None:
+            return None
+        array = ArrayObject([IndirectObject(page_id, 0, None)])
+        array.extend(dest.dest_array[1:])
+        return array
+
+    def _convert_outline(self, items, page_lookup, page_ids):
+        # pypdf gives a flat list where a nested list holds the children of the item before it
+        converted = []
+        for item in items:
+            if isinstance(item, list):
+                if converted:
+                    converted[-1]["children"] = self._convert_outline(item, page_lookup, page_ids)
+                continue
+            converted.append({
+                "title": item.title or "",
+                "dest": self._explicit_dest(item, page_lookup, page_ids),
+                "children": [],
+            })
+        return converted
+
+    def _collect_bookmarks(self, reader, title, page_ids):
+        # page_lookup is the page offset index for this input: source page -> output page,
+        # built once so resolving any number of destinations stays linear
+        page_lookup = {}
+        for page, page_id in zip(reader.pages, page_ids):
+            ref = page.indirect_reference
+            if ref is not None:
+                page_lookup[(ref.idnum, ref.generation)] = page_id
+
+        try:
+            children = self._convert_outline(reader.outline, page_lookup, page_ids)
+        except Exception:
+            children = []  # a broken outline is not worth failing the merge for
+        try:
+            for name, dest in reader.named_destinations.items():
+                array = self._explicit_dest(dest, page_lookup, page_ids)
+                if array is not None:
+                    self.named_dests[self._renames.get(name, name)] = array
+        except Exception:
+            pass
+
+        if page_ids:
+            file_dest = ArrayObject([IndirectObject(page_ids[0], 0, None), NameObject("/Fit")])
+            self.outline.append({"title": title, "dest": file_dest, "children": children})
+
+    def _plan_renames(self, reader):
+        # names an earlier input already defined get a per-input prefix, so links
+        # in this input keep jumping into this input and not the first one
+        try:
+            names = list(reader.named_destinations)
+        except Exception:
+            return {}
+        renames = {}
+        for name in names:
+            if name in self.named_dests:
+                renames[name] = _unique_name(name, self.inputs + 1, self.named_dests, names)
+        return renames
+
+    def append(self, path, password="", title=None):
+        reader = PdfReader(path)
+        if reader.is_encrypted and not reader.decrypt(password):
+            raise ValueError("PDF is encrypted")
+
+        self._mapping = {}
+        self._digests = {}
+        self._pending = []
+        self._renames = self._plan_renames(reader)
+        self.inputs += 1
+
+        # number the pages up front so links between pages resolve to the copies
+        pages = reader.pages
+        page_ids = []
+        for page in pages:
+            page_id = self._allocate()
+            if page.indirect_reference is not None:
+                ref = page.indirect_reference
+                self._mapping[(ref.idnum, ref.generation)] = page_id
+            page_ids.append(page_id)
+
+        for page, page_id in zip(pages, page_ids):
+            new_page = DictionaryObject()
+            for key, value in page.items():
+                if key != "/Parent":
+                    new_page[NameObject(key)] = self._translate(value)
+            new_page[NameObject("/Parent")] = IndirectObject(PAGES_ID, 0, None)
+            self._write_object(page_id, new_page)
+            self._flush_pending()
+
+        self._collect_bookmarks(reader, title or os.path.basename(path), page_ids)
+
+        self.page_ids.extend(page_ids)
+        self._mapping = {}
+        self._digests = {}
+        self._renames = {}
+        return len(page_ids)
+
+    def _write_outline_items(self, items, parent_id):
+        # returns (first id, last id, visible descendant count) for one sibling list
+        ids = [self._allocate() for _ in items]
+        total = 0
+        for index, (item, item_id) in enumerate(zip(items, ids)):
+            entry = DictionaryObject({
+                NameObject("/Title"): TextStringObject(item["title"]),
+                NameObject("/Parent"): IndirectObject(parent_id, 0, None),
+            })
+            if item["dest"] is not None:
+                entry[NameObject("/Dest")] = item["dest"]
+            if index > 0:
+                entry[NameObject("/Prev")] = IndirectObject(ids[index - 1], 0, None)
+            if index < len(ids) - 1:
+                entry[NameObject("/Next")] = IndirectObject(ids[index + 1], 0, None)
+            if item["children"]:
+                first_id, last_id, count = self._write_outline_items(item["children"], item_id)
+                entry[NameObject("/First")] = IndirectObject(first_id, 0, None)
+                entry[NameObject("/Last")] = IndirectObject(last_id, 0, None)
+                entry[NameObject("/Count")] = NumberObject(count)
+                total += count
+            self._write_object(item_id, entry)
+            total += 1
+        return ids[0], ids[-1], total
+
+    def _write_outline(self):
+        root_id = self._allocate()
+        first_id, last_id, count = self._write_outline_items(self.outline, root_id)
+        self._write_object(root_id, DictionaryObject({
+            NameObject("/Type"): NameObject("/Outlines"),
+            NameObject("/First"): IndirectObject(first_id, 0, None),
+            NameObject("/Last"): IndirectObject(last_id, 0, None),
+            NameObject("/Count"): NumberObject(count),
+        }))
+        return root_id
+
+    def close(self):
+        pages = DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(IndirectObject(page_id, 0, None) for page_id in self.page_ids),
+            NameObject("/Count"): NumberObject(len(self.page_ids)),
+        })
+        self._write_object(PAGES_ID, pages)
+
+        catalog = DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): IndirectObject(PAGES_ID, 0, None),
+        })
+        if self.outline:
+            catalog[NameObject("/Outlines")] = IndirectObject(self._write_outline(), 0, None)
+            catalog[NameObject("/PageMode")] = NameObject("/UseOutlines")
+        if self.named_dests:
+            names = ArrayObject()
+            for name in sorted(self.named_dests):
+                names.append(TextStringObject(name))
+                names.append(self.named_dests[name])
+            catalog[NameObject("/Names")] = DictionaryObject({
+                NameObject("/Dests"): DictionaryObject({NameObject("/Names"): names}),
+            })
+        self._write_object(CATALOG_ID, catalog)
+
+        xref_offset = self.output.tell()
+        self.output.write(f"xref\n0 {self.next_id}\n".encode())
+        self.output.write(b"0000000000 65535 f \n")
+        for obj_id in range(1, self.next_id):
+            self.output.write(f"{self.offsets[obj_id]:010d} 00000 n \n".encode())
+        self.output.write(f"trailer\n<< /Size {self.next_id} /Root {CATALOG_ID} 0 R >>\n".encode())
+        self.output.write(f"startxref\n{xref_offset}\n%%EOF\n".encode())
+        self.output.close()
+
+    def abort(self):
+        # leave without writing the trailer, the caller removes the partial file
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+
+class MergeError(Exception):
+    # raised by a backend when one of the inputs cannot be merged
+
+    def __init__(self, path, message):
+        # both go to Exception so the error survives pickling out of a worker process
+        super().__init__(path, message)
+        self.path = path
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class MergeBackend:
+    name = None
+
+    def merge(self, paths, output_path, progress=None, titles=None):
+        # merge paths in order into output_path and return the page count.
+        # progress(pages) is called after each input with that input's page count,
+        # titles name the top-level bookmark of each input (default: file name)
+        raise NotImplementedError
+
+
+class PypdfBackend(MergeBackend):
+    name = "pypdf"
+
+    def merge(self, paths, output_path, progress=None, titles=None):
+        titles = titles or [os.path.basename(path) for path in paths]
+        merger = StreamingPdfMerger(output_path)
+        for path, title in zip(paths, titles):
+            try:
+                pages = merger.append(path, title=title)
+            except Exception as e:
+                merger.abort()
+                os.remove(output_path)
+                raise MergeError(path, str(e))
+            if progress is not None:
+                progress(pages)
+        merger.close()
+        return len(merger.page_ids)
+
+
+class PymupdfBackend(MergeBackend):
+    name = "pymupdf"
+
+    def merge(self, paths, output_path, progress=None, titles=None):
+        titles = titles or [os.path.basename(path) for path in paths]
+        doc = fitz.open()
+        toc = []
+        named_dests = {}
+        try:
+            for number, (path, title) in enumerate(zip(paths, titles), 1):
+                offset = len(doc)
+                try:
+                    with fitz.open(path) as source:
+                        if source.needs_pass:
+                            raise ValueError("PDF is encrypted")
+                        doc.insert_pdf(source)
+                        pages = len(source)
+                        source_toc = source.get_toc(simple=False)
+                        source_names = _resolve_names(source)
+                except Exception as e:
+                    raise MergeError(path, str(e))
+                if pages:
+                    toc.append([1, title, offset + 1])
+                    toc.extend(_shift_toc(source_toc, offset))
+                # insert_pdf turns links into explicit ones, only the names themselves
+                # need carrying over, shifted by the page offset
+                for name, dest in source_names.items():
+                    if 0 <= dest["page"] < pages:
+                        if name in named_dests:
+                            name = _unique_name(name, number, named_dests, source_names)
+                        named_dests[name] = (offset + dest["page"], dest["to"], dest["zoom"])
+                if progress is not None:
+                    progress(pages)
+            if toc:
+                doc.set_toc(toc)
+            if named_dests:
+                _write_named_dests(doc, named_dests)
+            # garbage=4 also compares stream contents, so images, fonts etc. that
+            # several inputs carry are written once (garbage=3 keeps every copy)
+            doc.save(output_path, garbage=4, deflate=True)
+            return len(doc)
+        finally:
+            doc.close()
+
+
+def _shift_toc(toc, offset):
+    # one level down and offset pages. entries without a target page (often a parent
+    # that only groups its children) stay at page -1 so the level order holds
+    shifted = []
+    for level, title, page, dest in toc:
+        if page < 1:
+            shifted.append([level + 1, title, -1, dest])
+            continue
+        dest = dict(dest)
+        dest["page"] = page - 1 + offset
+        shifted.append([level + 1, title, page + offset, dest])
+    return shifted
+
+
+def _unique_name(name, input_number, *taken):
+    # name with the prefix of the input it came from, not used by anyone yet
+    new_name = f"f{input_number}_{name.lstrip('/')}"
+    while any(new_name in names for names in taken):
+        new_name = "_" + new_name
+    return new_name
+
+
+def _resolve_names(source):
+    # {name: {"page": 0-based, "to": (x, y), "zoom": z}}, a broken name tree is
+    # not worth failing the merge for
+    try:
+        return source.resolve_names()
+    except Exception:
+        return {}
+
+
+def _pdf_string(text):
+    # hex string, latin-1 bytes as is (names are matched byte for byte), else utf-16
+    try:
+        data = text.encode("latin-1")
+    except UnicodeEncodeError:
+        data = b"\xfe\xff" + text.encode("utf-16-be")
+    return data, f"<{data.hex()}>"
+
+
+def _write_named_dests(doc, named_dests):
+    # name tree under /Names /Dests of the catalog, one flat /Names array in key order
+    entries = []
+    for name, (page, (x, y), zoom) in named_dests.items():
+        key, string = _pdf_string(name)
+        entries.append((key, f"{string} [{doc[page].xref} 0 R /XYZ {x:g} {y:g} {zoom:g}]"))
+    entries.sort()
+    names_xref = doc.get_new_xref()
+    doc.update_object(names_xref, f"<< /Dests << /Names [{' '.join(entry for _, entry in entries)}] >> >>")
+    doc.xref_set_key(doc.pdf_catalog(), "Names", f"{names_xref} 0 R")
+
+
+BACKENDS = {backend.name: backend for backend in (PypdfBackend, PymupdfBackend)}
+
+
+def available_backends():
+    return [name for name in BACKENDS if name != "pymupdf" or fitz is not None]
+
+
+def get_backend(name):
+    if name not in available_backends():
+        raise ValueError(f"Unknown merge backend '{name}', choose one of: {', '.join(available_backends())}")
+    return BACKENDS[name]()
+
+
+def inspect_pdf(path):
+    # pre-flight check run in a worker process before anything is merged: the
+    # file must parse, its page tree must load and it must open without a password
+    info = {"path": path, "pages": 0, "encrypted": False, "error": None}
+    try:
+        reader = PdfReader(path)
+        if reader.is_encrypted:
+            info["encrypted"] = True
+            try:
+                opened = reader.decrypt("")
+            except Exception:
+                opened = False
+            if not opened:
+                info["error"] = "PDF is encrypted"
+                return info
+        info["pages"] = len(reader.pages)
+        if info["pages"] == 0:
+            info["error"] = "PDF has no pages"
+    except DependencyError:
+        # pypdf tries the empty password while opening, AES needs `cryptography`
+        info["encrypted"] = True
+        info["error"] = "PDF is encrypted"
+    except Exception as e:
+        info["error"] = str(e) or type(e).__name__
+    return info
@@ -1,12 +1,21 @@
 
 
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
 import os
+import sys
 import uuid
-from typing import List
-import pypdf
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from engine import get_backend, inspect_pdf, MergeError
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.transfer import spool_upload
 
 app = FastAPI()
 
@@ -16,11 +25,52 @@ MERGED_DIR = "merged"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(MERGED_DIR, exist_ok=True)
 
+# merge backend used when the request does not pick one, see engine.BACKENDS
+DEFAULT_MERGE_BACKEND = os.environ.get("MERGE_BACKEND", "pypdf")
+
+
+# inputs are checked in parallel across this many processes before a merge starts
+PREFLIGHT_WORKERS = int(os.environ.get("MERGE_PREFLIGHT_WORKERS", os.cpu_count() or 1))
+preflight_executor = ProcessPoolExecutor(max_workers=PREFLIGHT_WORKERS)
+
+# job id -> progress of a running (or recently finished) merge
+MAX_TRACKED_JOBS = 1000
+merge_progress = OrderedDict()
+
 
 app.mount("/files", StaticFiles(directory=MERGED_DIR), name="files")
 
+
+async def preflight(paths):
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(preflight_executor, inspect_pdf, path) for path in paths])
+
+
+def track_job(job_id, page_counts):
+    merge_progress[job_id] = {
+        "status": "merging",
+        "files_total": len(page_counts),
+        "files_done": 0,
+        "pages_total": sum(page_counts),
+        "pages_done": 0,
+    }
+    while len(merge_progress) > MAX_TRACKED_JOBS:
+        merge_progress.popitem(last=False)
+    progress = merge_progress[job_id]
+
+    def update(pages):
+        progress["files_done"] += 1
+        progress["pages_done"] += pages
+
+    return progress, update
+
+
 @app.post("/merge-pdf")
-async def merge_pdfs(files: List[UploadFile] = File(...)):
+async def merge_pdfs(
+    files: List[UploadFile] = File(...),
+    backend: str = Form(DEFAULT_MERGE_BACKEND),
+    job_id: Optional[str] = Form(None),
+):
    
     if not files:
         return JSONResponse(
@@ -42,12 +92,24 @@ async def merge_pdfs(files: List[UploadFile] = File(...)):
                 }
             )
     
+    try:
+        merge_backend = get_backend(backend)
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
     
     unique_id = str(uuid.uuid4())
+    job_id = job_id or unique_id
     merged_filename = f"{unique_id}.pdf"
     
     
     saved_paths = []
+    titles = []
     try:
         for file in files:
             
@@ -55,11 +117,10 @@ async def merge_pdfs(files: List[UploadFile] = File(...)):
             file_path = os.path.join(UPLOAD_DIR, safe_filename)
             
           
-            file_content = await file.read()
-            with open(file_path, "wb") as f:
-                f.write(file_content)
+            await spool_upload(file, file_path)
             
             saved_paths.append(file_path)
+            titles.append(os.path.splitext(os.path.basename(file.filename))[0])
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -70,31 +131,41 @@ async def merge_pdfs(files: List[UploadFile] = File(...)):
         )
     
  
-    try:
-        pdf_writer = pypdf.PdfWriter()
-        
-        for pdf_path in saved_paths:
-            try:
-          
-                with open(pdf_path, 'rb') as pdf_file:
-                    pdf_reader = pypdf.PdfReader(pdf_file)
-                
-                    for page_num in range(len(pdf_reader.pages)):
-                        pdf_writer.add_page(pdf_reader.pages[page_num])
-            except Exception as e:
-                return JSONResponse(
-                    status_code=400,
-                    content={
-                        "status": "error",
-                        "message": f"Error with PDF file '{os.path.basename(pdf_path)}': {str(e)}"
-                    }
+    # every input is validated up front so a bad batch fails before any merging
+    checks = await preflight(saved_paths)
+    failed = [check for check in checks if check["error"] is not None]
+    if failed:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": "; ".join(
+                    f"Error with PDF file '{os.path.basename(check['path'])}': {check['error']}" for check in failed
                 )
+            }
+        )
+    page_counts = [check["pages"] for check in checks]
+    progress, update_progress = track_job(job_id, page_counts)
 
+    try:
         merged_path = os.path.join(MERGED_DIR, merged_filename)
-        with open(merged_path, "wb") as output_file:
-            pdf_writer.write(output_file)
+
+        try:
+            # off the event loop so /merge-progress can be polled meanwhile
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, merge_backend.merge, saved_paths, merged_path, update_progress, titles)
+        except MergeError as e:
+            progress["status"] = "error"
+            return JSONResponse(
+                status_code=400,
+                content={
+                    "status": "error",
+                    "message": f"Error with PDF file '{os.path.basename(e.path)}': {str(e)}"
+                }
+            )
         
     except Exception as e:
+        progress["status"] = "error"
         return JSONResponse(
             status_code=500,
             content={
@@ -104,20 +175,33 @@ async def merge_pdfs(files: List[UploadFile] = File(...)):
         )
     
 
+    progress["status"] = "done"
+
     base_url = "http://127.0.0.1:8000"  
     return JSONResponse(
         status_code=200,
         content={
             "status": "success",
             "message": "Successfully merged PDF files!",
-            "download_link": f"{base_url}/files/{merged_filename}"
+            "download_link": f"{base_url}/files/{merged_filename}",
+            "job_id": job_id,
+            "pages": sum(page_counts),
+            "page_counts": page_counts
         }
     )
 
+
+@app.get("/merge-progress/{job_id}")
+def read_progress(job_id: str):
+    progress = merge_progress.get(job_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Unknown job id")
+    return progress
+
 # Root endpoint
 @app.get("/")
 def read_root():
     return {"message": "PDF Merger API - Upload PDFs to /merge-pdfs/ endpoint"}
 
 
-# its a merging pdf files project its working well.
\ No newline at end of file
+# its a merging pdf files project its working well.
\ No newline at end of file
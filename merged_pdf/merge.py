@@ -1,43 +1,239 @@
-import os
-from PyPDF2 import PdfMerger
-
-
-pdf_folder = r"D:\\v_projects\\pdf project\\merged_pdf"
-
-
-pdf_files = [
-    os.path.join(pdf_folder, f)
-    for f in os.listdir(pdf_folder)
-    if f.lower().endswith(".pdf")
-]
-
-pdf_files.sort()
-
-
-if not pdf_files:
-    print(" No PDF files found in the folder.")
-    exit()
 
+# batch merge cli
+#
+# merges the PDFs of one or more folders, one output file per group, several
+# groups at a time in a process pool. finished groups are recorded in a manifest
+# so a rerun after a crash (or with --watch) only redoes what changed.
+#
+#   python merge.py "D:\scans\jan" "D:\scans\feb" -o merged --sort natural
+#   python merge.py scans --recursive --pattern "*.pdf" --workers 4 --watch 30
+#   python merge.py a b c --group-by none --name all.pdf
 
-output_folder = os.path.join(pdf_folder, "mergedpdf")
-os.makedirs(output_folder, exist_ok=True)
-
+import os
+import re
+import sys
+import json
+import time
+import glob
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from engine import available_backends, get_backend
+
+
+def natural_key(path):
+    # "page2.pdf" sorts before "page10.pdf"
+    name = os.path.basename(path).lower()
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+SORT_KEYS = {
+    "name": lambda path: os.path.basename(path).lower(),
+    "natural": natural_key,
+    "mtime": os.path.getmtime,
+    "size": os.path.getsize,
+}
+
+
+def is_within(path, folder):
+    # path is folder or somewhere below it (a plain prefix would also match "folder_2")
+    path, folder = os.path.abspath(path), os.path.abspath(folder)
+    return os.path.commonpath([path, folder]) == folder
+
+
+def find_pdfs(directory, pattern, recursive, exclude):
+    # {folder: [pdf paths]} for directory (and every subfolder when recursive)
+    found = {}
+    folders = [directory]
+    if recursive:
+        folders = [root for root, _, _ in os.walk(directory)]
+    # never pick up our own output, unless the output folder is (or holds) the input
+    skip_output = not is_within(directory, exclude)
+    for folder in folders:
+        if skip_output and is_within(folder, exclude):
+            continue
+        paths = [
+            path for path in glob.glob(os.path.join(folder, pattern))
+            if os.path.isfile(path) and path.lower().endswith(".pdf")
+        ]
+        if paths:
+            found[folder] = paths
+    return found
+
+
+def build_groups(args):
+    # {group name: [ordered pdf paths]}
+    by_folder = {}
+    exclude = os.path.abspath(args.output)
+    for directory in args.inputs:
+        if not os.path.isdir(directory):
+            print(f" Skipping {directory}: not a folder")
+            continue
+        by_folder.update(find_pdfs(directory, args.pattern, args.recursive, exclude))
+
+    sort_key = SORT_KEYS[args.sort]
+    groups = {}
+    if args.group_by == "none":
+        paths = [path for folder in by_folder for path in by_folder[folder]]
+        if paths:
+            groups[os.path.splitext(args.name)[0]] = sorted(paths, key=sort_key, reverse=args.reverse)
+    else:
+        for folder, paths in by_folder.items():
+            name = os.path.basename(os.path.normpath(folder)) or "root"
+            # two folders with the same name must not write to the same output
+            if name in groups:
+                name = f"{name}_{hashlib.sha1(folder.encode()).hexdigest()[:8]}"
+            groups[name] = sorted(paths, key=sort_key, reverse=args.reverse)
+    return groups
+
+
+def signature(paths):
+    # changes whenever a file is added, removed, reordered or modified
+    sha1 = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        sha1.update(f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return sha1.hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        print(f" Ignoring unreadable manifest {path}")
+        return {}
 
-output_path = os.path.join(output_folder, "merged_output.pdf")
 
+def save_manifest(path, manifest):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
 
-merger = PdfMerger()
 
-for pdf in pdf_files:
+def merge_group(backend_name, paths, output_path):
+    # runs in a worker process
+    start = time.perf_counter()
+    titles = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    tmp_path = f"{output_path}.part"
     try:
-        print(f"Adding: {pdf}")
-        with open(pdf, "rb") as f:
-            merger.append(f)
-    except Exception as e:
-        print(f" Skipping {pdf} due to error: {e}")
-
-
-merger.write(output_path)
-merger.close()
-
-print(f"\n Merged PDF saved successfully at:\n{output_path}")
+        pages = get_backend(backend_name).merge(paths, tmp_path, titles=titles)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # only a complete file ever appears under the final name
+    os.replace(tmp_path, output_path)
+    return pages, time.perf_counter() - start
+
+
+def run_once(args, manifest):
+    groups = build_groups(args)
+    if not groups:
+        print(" No PDF files found.")
+        return []
+
+    os.makedirs(args.output, exist_ok=True)
+    results = []
+    todo = {}
+    for name, paths in groups.items():
+        output_path = os.path.join(args.output, f"{name}.pdf")
+        sig = signature(paths)
+        done = manifest.get(name)
+        if done and done["signature"] == sig and os.path.exists(output_path) and not args.force:
+            results.append((name, len(paths), done["pages"], 0.0, "skipped"))
+            continue
+        todo[name] = (paths, output_path, sig)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(merge_group, args.backend, paths, output_path): name
+            for name, (paths, output_path, _) in todo.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            paths, output_path, sig = todo[name]
+            try:
+                pages, seconds = future.result()
+            except Exception as e:
+                print(f" {name} failed: {e}")
+                results.append((name, len(paths), 0, 0.0, "failed"))
+                continue
+            manifest[name] = {
+                "output": output_path,
+                "signature": sig,
+                "files": len(paths),
+                "pages": pages,
+                "seconds": round(seconds, 3),
+            }
+            # written after every group so a crash loses at most the groups in flight
+            save_manifest(args.manifest, manifest)
+            print(f" Merged {name}: {len(paths)} files, {pages} pages in {seconds:.2f}s")
+            results.append((name, len(paths), pages, seconds, "merged"))
+    return results
+
+
+def print_summary(results):
+    if not results:
+        return
+    width = max(len("group"), max(len(name) for name, *_ in results))
+    header = f"{'group':<{width}}  {'files':>6}  {'pages':>7}  {'seconds':>8}  {'pages/s':>8}  status"
+    print()
+    print(header)
+    print("-" * len(header))
+    for name, files, pages, seconds, status in sorted(results):
+        rate = f"{pages / seconds:.1f}" if seconds else "-"
+        print(f"{name:<{width}}  {files:>6}  {pages:>7}  {seconds:>8.2f}  {rate:>8}  {status}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Merge folders of PDFs, one output file per group")
+    parser.add_argument("inputs", nargs="+", help="folders to read PDFs from")
+    parser.add_argument("-o", "--output", default="mergedpdf", help="folder for the merged files")
+    parser.add_argument("--pattern", default="*.pdf", help="glob pattern for input files")
+    parser.add_argument("--sort", choices=sorted(SORT_KEYS), default="name", help="order of files within a group")
+    parser.add_argument("--reverse", action="store_true", help="reverse the sort order")
+    parser.add_argument("--recursive", action="store_true", help="also look in subfolders")
+    parser.add_argument("--group-by", choices=["folder", "none"], default="folder",
+                        help="one output per folder, or everything into a single output")
+    parser.add_argument("--name", default="merged_output.pdf", help="output name with --group-by none")
+    parser.add_argument("--backend", choices=available_backends(), default="pypdf")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="groups merged at the same time")
+    parser.add_argument("--manifest", default=None, help="checkpoint file (default: <output>/manifest.json)")
+    parser.add_argument("--force", action="store_true", help="merge every group even if the manifest has it")
+    parser.add_argument("--watch", type=float, default=None, metavar="SECONDS",
+                        help="keep running and rescan the folders every SECONDS")
+    args = parser.parse_args(argv)
+    if args.manifest is None:
+        args.manifest = os.path.join(args.output, "manifest.json")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    manifest = load_manifest(args.manifest)
+
+    if args.watch is None:
+        results = run_once(args, manifest)
+        print_summary(results)
+        return 1 if any(status == "failed" for *_, status in results) else 0
+
+    print(f" Watching {', '.join(args.inputs)} every {args.watch}s, Ctrl+C to stop")
+    try:
+        while True:
+            results = run_once(args, manifest)
+            if any(status != "skipped" for *_, status in results):
+                print_summary(results)
+            # only force the first pass
+            args.force = False
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,325 @@
+
+# pdf sessions fastapi
+#
+# upload a PDF once, get a session id, then split / compress / number it as many
+# times as you like without uploading it again. the parsed document stays open
+# in this worker until the session has been idle for SESSION_TTL seconds, so run
+# this service with a single worker (or sticky routing on the session id).
+
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import threading
+import importlib.util
+from contextlib import asynccontextmanager
+from typing import List, Optional, Literal, Union, Annotated
+
+import fitz
+from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel, Field
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(BASE_DIR)
+UPLOAD_DIRECTORY = os.path.join(BASE_DIR, "session_uploads")
+OUTPUT_DIRECTORY = os.path.join(BASE_DIR, "session_outputs")
+os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
+os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
+
+# seconds a session may sit idle before its document is closed and dropped
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 1800))
+# most sessions kept open at once, the least recently used goes first
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 100))
+
+
+def load_tool_module(folder, name):
+    # the tools live in folders with spaces in their names, so load by path
+    path = os.path.join(PROJECT_DIR, folder, f"{name}.py")
+    spec = importlib.util.spec_from_file_location(f"{folder.replace(' ', '_')}_{name}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+compressor = load_tool_module("compress pdf", "compressor")
+numbering = load_tool_module("add pg no", "numbering")
+transfer = load_tool_module("shared", "transfer")
+
+
+class Session:
+
+    def __init__(self, session_id, filename, path):
+        self.id = session_id
+        self.filename = filename
+        self.path = path
+        self.doc = fitz.open(path)
+        self.save_options = {"garbage": 1, "deflate": True}
+        self.history = []
+        self.last_used = time.monotonic()
+        # fitz documents are not thread safe, one operation at a time per session
+        self.lock = threading.Lock()
+
+    def info(self):
+        return {
+            "session_id": self.id,
+            "filename": self.filename,
+            "pages": len(self.doc),
+            "operations": self.history,
+            "expires_in": max(0, round(SESSION_TTL - (time.monotonic() - self.last_used))),
+        }
+
+    def close(self):
+        self.doc.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+def get_session(session_id):
+    with sessions_lock:
+        session = sessions.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found or expired")
+        session.last_used = time.monotonic()
+        return session
+
+
+def drop_session(session_id):
+    with sessions_lock:
+        session = sessions.pop(session_id, None)
+    if session is not None:
+        with session.lock:
+            session.close()
+
+
+def expire_sessions():
+    now = time.monotonic()
+    with sessions_lock:
+        expired = [sid for sid, session in sessions.items() if now - session.last_used > SESSION_TTL]
+    for session_id in expired:
+        drop_session(session_id)
+
+
+async def sweep_sessions():
+    # drop_session waits for a running job on that session to finish, keep it off the loop
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(60)
+        await loop.run_in_executor(None, expire_sessions)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    sweeper = asyncio.create_task(sweep_sessions())
+    yield
+    sweeper.cancel()
+    for session_id in list(sessions):
+        drop_session(session_id)
+
+
+app = FastAPI(title="PDF Sessions API", lifespan=lifespan)
+
+app.mount("/files", StaticFiles(directory=OUTPUT_DIRECTORY), name="files")
+
+
+# operations, each one changes the open document in place
+
+class SplitOperation(BaseModel):
+    op: Literal["split"]
+    start_page: int
+    end_page: int
+
+
+class CompressOperation(BaseModel):
+    op: Literal["compress"]
+    quality_level: str = "Medium"
+
+
+class PageNumbersOperation(BaseModel):
+    op: Literal["page_numbers"]
+    format: str = " {n} "
+    position: str = "bottom"
+    start: int = 1
+    first_page: int = 1
+    skip: Optional[str] = None
+    font_size: float = 10
+
+
+Operation = Annotated[Union[SplitOperation, CompressOperation, PageNumbersOperation], Field(discriminator="op")]
+
+
+class RunRequest(BaseModel):
+    operations: List[Operation]
+    export: bool = True
+
+
+def apply_split(session, operation):
+    total_pages = len(session.doc)
+    if operation.start_page < 1 or operation.end_page > total_pages or operation.start_page > operation.end_page:
+        raise ValueError(f"Invalid page range. The PDF has {total_pages} pages.")
+    session.doc.select(list(range(operation.start_page - 1, operation.end_page)))
+    return {"pages": len(session.doc)}
+
+
+def apply_compress(session, operation):
+    quality_level = compressor.normalize_quality(operation.quality_level)
+    preset = compressor.get_preset(quality_level)
+    stats = {}
+    if preset["images"] is not None:
+        stats["images"] = compressor.compress_images(session.doc, preset["images"])
+    # the save side of the preset is applied when the session is exported
+    session.save_options = dict(preset["save"])
+    return stats
+
+
+def apply_page_numbers(session, operation):
+    numbered = numbering.number_pages(
+        session.doc,
+        fmt=operation.format,
+        position=operation.position,
+        start=operation.start,
+        first_page=operation.first_page,
+        skip=operation.skip,
+        fontsize=operation.font_size,
+    )
+    return {"pages": len(session.doc), "numbered": numbered}
+
+
+OPERATIONS = {
+    "split": apply_split,
+    "compress": apply_compress,
+    "page_numbers": apply_page_numbers,
+}
+
+
+def reopen_session(session):
+    if not session.doc.is_closed:
+        session.doc.close()
+    session.doc = fitz.open(session.path)
+
+
+def checkpoint_session(session):
+    # write pending edits from earlier runs to session.path, so a failed run can
+    # roll back to exactly where it started by reopening that file
+    if not session.doc.is_dirty:
+        return
+    tmp_path = f"{session.path}.tmp"
+    session.doc.save(tmp_path, garbage=1, deflate=True)
+    session.doc.close()
+    os.replace(tmp_path, session.path)
+    session.doc = fitz.open(session.path)
+
+
+def run_operations(session, operations, export=False):
+    # all or nothing: when one operation (or the export after them) fails, the
+    # ones before it are undone too, otherwise a retry would apply them twice
+    # (e.g. number the pages again). returns (results, download link or None)
+    checkpoint_session(session)
+    history = list(session.history)
+    save_options = dict(session.save_options)
+    results = []
+    try:
+        for operation in operations:
+            result = OPERATIONS[operation.op](session, operation)
+            session.history.append(operation.op)
+            results.append({"op": operation.op, **result})
+        download_link = export_session(session) if export else None
+    except Exception:
+        reopen_session(session)
+        session.history = history
+        session.save_options = save_options
+        raise
+    return results, download_link
+
+
+def export_session(session):
+    output_filename = f"{uuid.uuid4()}.pdf"
+    output_path = os.path.join(OUTPUT_DIRECTORY, output_filename)
+    tmp_path = f"{session.path}.tmp"
+    try:
+        session.doc.save(output_path, **session.save_options)
+        # session.path is the rollback point until the export is through, replace it in one go
+        shutil.copyfile(output_path, tmp_path)
+    except Exception:
+        for path in (output_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+    # keep working on what was just written, so later operations build on it
+    # and the document does not carry the edits as pending changes
+    session.doc.close()
+    os.replace(tmp_path, session.path)
+    session.doc = fitz.open(session.path)
+
+    base_url = "http://127.0.0.1:8000"
+    return f"{base_url}/files/{output_filename}"
+
+
+@app.post("/sessions")
+async def create_session(file: UploadFile = File(...)):
+    if not file.filename.lower().endswith(".pdf"):
+        return JSONResponse(status_code=400, content={"status": "error", "message": "Only PDF files are allowed"})
+
+    session_id = str(uuid.uuid4())
+    path = os.path.join(UPLOAD_DIRECTORY, f"{session_id}.pdf")
+    await transfer.spool_upload(file, path)
+
+    try:
+        session = Session(session_id, file.filename, path)
+    except Exception as e:
+        os.remove(path)
+        return JSONResponse(status_code=400, content={"status": "error", "message": f"Could not open PDF: {str(e)}"})
+
+    with sessions_lock:
+        sessions[session_id] = session
+        overflow = len(sessions) - MAX_SESSIONS
+        oldest = sorted(sessions.values(), key=lambda s: s.last_used)[:max(0, overflow)]
+    # drop_session waits for a running job on that session to finish, keep it off the loop
+    loop = asyncio.get_running_loop()
+    for old in oldest:
+        loop.run_in_executor(None, drop_session, old.id)
+
+    return {"status": "success", "message": "Session created", **session.info()}
+
+
+@app.get("/sessions/{session_id}")
+def read_session(session_id: str):
+    session = get_session(session_id)
+    return {"status": "success", **session.info()}
+
+
+@app.post("/sessions/{session_id}/run")
+def run_session(session_id: str, request: RunRequest):
+    session = get_session(session_id)
+    with session.lock:
+        try:
+            results, download_link = run_operations(session, request.operations, request.export)
+            content = {"status": "success", "message": "Operations applied", "results": results}
+            if download_link is not None:
+                content["download_link"] = download_link
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
+        content.update(session.info())
+    return content
+
+
+@app.delete("/sessions/{session_id}")
+def delete_session(session_id: str):
+    get_session(session_id)
+    drop_session(session_id)
+    return {"status": "success", "message": "Session closed"}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="127.0.0.1", port=8000)
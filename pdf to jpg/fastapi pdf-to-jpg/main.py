@@ -4,88 +4,225 @@
 # this is a fastapi code to convert pdf to jpg
 
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from concurrent.futures import ProcessPoolExecutor
+from collections import OrderedDict
+import asyncio
+import zipfile
 import fitz
 import os
+import sys
+import time
 import uuid
 import shutil
 from pathlib import Path
 
-app = FastAPI()
+from rasterizer import (
+    DEFAULT_QUALITY, FORMATS, RenderStats, check_options, count_pages, page_name, parse_dpis,
+    plan_shards, render_shard,
+)
+from render_cache import RenderCache
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from shared.transfer import ZipSink, content_disposition, spool_upload
+
+
+RENDER_DPI = 200
+RENDER_WORKERS = int(os.environ.get("RENDER_WORKERS", os.cpu_count() or 1))
+render_executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS)
+render_stats = RenderStats(RENDER_WORKERS)
+
+# page-by-page jobs kept around for GET .../pages/{n}, oldest dropped first
+MAX_PAGE_JOBS = int(os.environ.get("MAX_PAGE_JOBS", 50))
+# how long a page request waits for a page that is still rendering
+PAGE_WAIT_TIMEOUT = float(os.environ.get("PAGE_WAIT_TIMEOUT", 120))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    render_executor.shutdown(cancel_futures=True)
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 UPLOAD_DIR = Path("uploads")
 OUTPUT_DIR = Path("output_jpg")
 STATIC_FILES_DIR = Path("files")
+RENDERS_DIR = Path("renders")
 
 for directory in [UPLOAD_DIR, OUTPUT_DIR, STATIC_FILES_DIR]:
     directory.mkdir(exist_ok=True)
 
+render_cache = RenderCache(RENDERS_DIR, int(os.environ.get("RENDER_CACHE_MAX_MB", 2048)) * 1024 * 1024)
+
 
 app.mount("/files", StaticFiles(directory=str(STATIC_FILES_DIR)), name="files")
+app.mount("/renders", StaticFiles(directory=str(RENDERS_DIR)), name="renders")
+
+
+def pdf_only_error():
+    return JSONResponse(
+        status_code=400,
+        content={
+            "status": "error",
+            "message": "pdf files only"
+        }
+    )
+
+
+def options_error(e):
+    return JSONResponse(status_code=400, content={"status": "error", "message": str(e)})
+
+
+async def save_upload(file, unique_id):
+    # returns the path and the sha256 of the upload
+    file_path = UPLOAD_DIR / f"{unique_id}.pdf"
+    digest, _ = await spool_upload(file, file_path)
+    return file_path, digest
+
+
+async def get_page_count(file_path, digest):
+    page_count = render_cache.page_count(digest)
+    if page_count is None:
+        loop = asyncio.get_running_loop()
+        page_count = await loop.run_in_executor(render_executor, count_pages, str(file_path))
+        render_cache.set_page_count(digest, page_count)
+    return page_count
+
+
+def cached_sizes(digest, page_count, dpis, fmt, quality):
+    # {page_number: [dpis in the render cache]}, every lookup stats a file
+    return {
+        page_number: [
+            dpi for dpi in dpis
+            if render_cache.get(render_cache.make_key(digest, page_number, dpi, fmt, quality)) is not None
+        ]
+        for page_number in range(1, page_count + 1)
+    }
+
+
+def read_cached(digest, page_number, dpis, fmt, quality):
+    # {dpi: image bytes} for sizes already looked up, one evicted since then is left out
+    images = {}
+    for dpi in dpis:
+        try:
+            images[dpi] = render_cache.path(render_cache.make_key(digest, page_number, dpi, fmt, quality)).read_bytes()
+        except FileNotFoundError:
+            pass
+    return images
+
+
+def store_rendered(digest, page_number, images, fmt, quality):
+    for dpi, data in images.items():
+        render_cache.put(render_cache.make_key(digest, page_number, dpi, fmt, quality), data)
+
+
+async def render_pages(file_path, digest, page_count, dpis=(RENDER_DPI,), fmt="jpg", quality=DEFAULT_QUALITY,
+                       load_cached=True):
+    # yields (page_number, {dpi: image bytes}). pages found in the render cache
+    # come first, then the rest in the order the shards finish; only the sizes
+    # missing from the cache are rendered, and they are added to it. with
+    # load_cached=False fully cached pages are only looked up, not read or yielded.
+    # the cache is all disk I/O, so lookups, reads and writes run in threads
+    loop = asyncio.get_running_loop()
+    found = await loop.run_in_executor(None, cached_sizes, digest, page_count, dpis, fmt, quality)
+    cached = {}
+    missing = {}
+    for page_number in range(1, page_count + 1):
+        if load_cached and found[page_number]:
+            images = await loop.run_in_executor(None, read_cached, digest, page_number, found[page_number], fmt, quality)
+        else:
+            images = dict.fromkeys(found[page_number])
+        todo = tuple(dpi for dpi in dpis if dpi not in images)
+        if todo:
+            missing.setdefault(todo, []).append(page_number - 1)
+            cached[page_number] = images
+        elif load_cached:
+            yield page_number, images
+
+    started = time.perf_counter()
+    jobs = [
+        loop.run_in_executor(render_executor, render_shard, str(file_path), pages, todo, fmt, quality)
+        for todo, group in missing.items()
+        for pages in plan_shards(group, RENDER_WORKERS)
+    ]
+    rendered = 0
+    render_seconds = 0.0
+    try:
+        for job in asyncio.as_completed(jobs):
+            for page_number, images, seconds in await job:
+                rendered += 1
+                render_seconds += seconds
+                await loop.run_in_executor(None, store_rendered, digest, page_number, images, fmt, quality)
+                images.update(cached.pop(page_number))
+                yield page_number, images
+    finally:
+        # a client that hung up doesn't keep the workers busy
+        for job in jobs:
+            job.cancel()
+        await loop.run_in_executor(None, render_cache.flush)
+    if rendered:
+        render_stats.record(rendered, time.perf_counter() - started, render_seconds)
+
 
 @app.post("/convert-pdf-to-jpg/")
-async def convert_pdf_to_jpg(file: UploadFile = File(...)):
-    
+async def convert_pdf_to_jpg(
+    file: UploadFile = File(...),
+    dpi: int = Form(RENDER_DPI),
+    format: str = Form("jpg"),
+    quality: int = Form(DEFAULT_QUALITY)
+):
+
     # Validate file is a PDF
     if not file.filename.lower().endswith(".pdf"):
-        return JSONResponse(
-            status_code=400,
-            content={
-                "status": "error",
-                "message": "pdf files only" 
-            }
-        )
-    
+        return pdf_only_error()
+    format = format.lower()
+    try:
+        check_options([dpi], format, quality)
+    except ValueError as e:
+        return options_error(e)
+
     # Generate unique ID for this conversion
     unique_id = str(uuid.uuid4())
-    output_folder = OUTPUT_DIR / unique_id
-    output_folder.mkdir(exist_ok=True)
-    
-    # Save the uploaded file
-    file_path = UPLOAD_DIR / f"{unique_id}.pdf"
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    # try:
-    #     # Convert PDF to JPGs
-    #     doc = fitz.open(file_path)
-    #     for page_number in range(len(doc)):
-    #         page = doc.load_page(page_number)
-    #         pix = page.get_pixmap(dpi=200)
-    #         output_path = output_folder / f"page_{page_number + 1}.jpg"
-    #         pix.save(str(output_path))
 
+    # Save the uploaded file
+    file_path, digest = await save_upload(file, unique_id)
 
     try:
-    # Convert PDF to JPGs (using context manager)
-        with fitz.open(file_path) as doc:
-            for page_number in range(len(doc)):
-                page = doc.load_page(page_number)
-                pix = page.get_pixmap(dpi=200)
-                output_path = output_folder / f"page_{page_number + 1}.jpg"
-                pix.save(str(output_path))
-
-        
-        # Create a zip file with all JPGs (optional - for multiple pages)
+        # pages go straight from the workers (or the render cache) into the zip
+        # (stored, jpg doesn't compress any further), nothing is written twice.
+        # the zip is on disk, every write to it runs in a thread
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        page_count = await get_page_count(file_path, digest)
         zip_path = STATIC_FILES_DIR / f"{unique_id}.zip"
-        shutil.make_archive(str(zip_path.with_suffix("")), 'zip', output_folder)
-        
-        # For simplicity, also copy the first page as a standalone JPG
-        first_jpg = output_folder / "page_1.jpg"
-        if first_jpg.exists():
-            jpg_download_path = STATIC_FILES_DIR / f"{unique_id}.jpg"
-            shutil.copy(first_jpg, jpg_download_path)
-            
+        archive = await loop.run_in_executor(None, zipfile.ZipFile, zip_path, "w", zipfile.ZIP_STORED)
+        try:
+            async for page_number, images in render_pages(file_path, digest, page_count, [dpi], format, quality):
+                await loop.run_in_executor(None, archive.writestr, page_name(page_number, format), images[dpi])
+                # For simplicity, also keep the first page as a standalone image
+                if page_number == 1:
+                    await loop.run_in_executor(None, (STATIC_FILES_DIR / f"{unique_id}.{format}").write_bytes, images[dpi])
+        finally:
+            await loop.run_in_executor(None, archive.close)
+        elapsed = time.perf_counter() - started
+
         return JSONResponse(
             content={
                 "status": "success",
                 "message": "pdf file converted into jpg successfully!",
-                "download_link": f"http://127.0.0.1:8000/files/{unique_id}.zip"
+                "download_link": f"http://127.0.0.1:8000/files/{unique_id}.zip",
+                "pages": page_count,
+                "seconds": round(elapsed, 3),
+                "pages_per_sec": round(page_count / elapsed, 2) if elapsed else None
             }
         )
-    
+
     except Exception as e:
         return JSONResponse(
             status_code=500,
@@ -99,6 +236,234 @@ async def convert_pdf_to_jpg(file: UploadFile = File(...)):
         if file_path.exists():
             file_path.unlink()
 
+
+@app.post("/convert-pdf-to-jpg/stream")
+async def convert_pdf_to_jpg_stream(
+    file: UploadFile = File(...),
+    dpi: int = Form(RENDER_DPI),
+    format: str = Form("jpg"),
+    quality: int = Form(DEFAULT_QUALITY)
+):
+    # the zip is the response body, each page is sent as soon as it is rendered
+    if not file.filename.lower().endswith(".pdf"):
+        return pdf_only_error()
+    format = format.lower()
+    try:
+        check_options([dpi], format, quality)
+    except ValueError as e:
+        return options_error(e)
+
+    unique_id = str(uuid.uuid4())
+    file_path, digest = await save_upload(file, unique_id)
+    try:
+        page_count = await get_page_count(file_path, digest)
+    except Exception as e:
+        file_path.unlink()
+        return JSONResponse(status_code=400, content={"status": "error", "message": f"Could not open PDF: {str(e)}"})
+
+    async def stream():
+        sink = ZipSink()
+        try:
+            with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+                async for page_number, images in render_pages(file_path, digest, page_count, [dpi], format, quality):
+                    archive.writestr(page_name(page_number, format), images[dpi])
+                    yield sink.take()
+            # central directory
+            yield sink.take()
+        finally:
+            if file_path.exists():
+                file_path.unlink()
+
+    base_name = os.path.splitext(os.path.basename(file.filename))[0] or "pages"
+    return StreamingResponse(
+        stream(),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": content_disposition(f"{base_name}_{format}.zip"),
+            "X-Page-Count": str(page_count),
+        },
+    )
+
+
+# page-by-page delivery: POST starts a render job and returns at once, pages are
+# fetched one by one and each request only waits for the page it asks for
+
+class PageJob:
+
+    def __init__(self, unique_id, digest, page_count, dpi, fmt, quality):
+        self.id = unique_id
+        self.digest = digest
+        self.page_count = page_count
+        self.dpi = dpi
+        self.format = fmt
+        self.quality = quality
+        self.folder = OUTPUT_DIR / unique_id
+        self.ready = [asyncio.Event() for _ in range(page_count)]
+        self.error = None
+        self.task = None
+
+    @property
+    def rendered(self):
+        return sum(event.is_set() for event in self.ready)
+
+    def info(self):
+        return {
+            "job_id": self.id,
+            "pages": self.page_count,
+            "rendered": self.rendered,
+            "error": self.error,
+            "page_urls": [
+                f"http://127.0.0.1:8000/convert-pdf-to-jpg/jobs/{self.id}/pages/{page_number}"
+                for page_number in range(1, self.page_count + 1)
+            ],
+        }
+
+    async def run(self, file_path):
+        loop = asyncio.get_running_loop()
+        try:
+            async for page_number, images in render_pages(file_path, self.digest, self.page_count, [self.dpi], self.format, self.quality):
+                page_path = self.folder / page_name(page_number, self.format)
+                await loop.run_in_executor(None, page_path.write_bytes, images[self.dpi])
+                self.ready[page_number - 1].set()
+        except Exception as e:
+            self.error = str(e)
+            # wake everyone up, the pages they wait for will never come
+            for event in self.ready:
+                event.set()
+        finally:
+            if file_path.exists():
+                file_path.unlink()
+
+    def discard(self):
+        if self.task is not None:
+            self.task.cancel()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+page_jobs = OrderedDict()
+
+
+@app.post("/convert-pdf-to-jpg/jobs")
+async def start_page_job(
+    file: UploadFile = File(...),
+    dpi: int = Form(RENDER_DPI),
+    format: str = Form("jpg"),
+    quality: int = Form(DEFAULT_QUALITY)
+):
+    if not file.filename.lower().endswith(".pdf"):
+        return pdf_only_error()
+    format = format.lower()
+    try:
+        check_options([dpi], format, quality)
+    except ValueError as e:
+        return options_error(e)
+
+    unique_id = str(uuid.uuid4())
+    file_path, digest = await save_upload(file, unique_id)
+    try:
+        page_count = await get_page_count(file_path, digest)
+    except Exception as e:
+        file_path.unlink()
+        return JSONResponse(status_code=400, content={"status": "error", "message": f"Could not open PDF: {str(e)}"})
+
+    job = PageJob(unique_id, digest, page_count, dpi, format, quality)
+    job.folder.mkdir(exist_ok=True)
+    page_jobs[unique_id] = job
+    while len(page_jobs) > MAX_PAGE_JOBS:
+        _, old = page_jobs.popitem(last=False)
+        old.discard()
+    job.task = asyncio.create_task(job.run(file_path))
+
+    return {"status": "success", "message": "rendering started", **job.info()}
+
+
+def get_page_job(job_id):
+    job = page_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.get("/convert-pdf-to-jpg/jobs/{job_id}")
+async def read_page_job(job_id: str):
+    return {"status": "success", **get_page_job(job_id).info()}
+
+
+@app.get("/convert-pdf-to-jpg/jobs/{job_id}/pages/{page_number}")
+async def read_page(job_id: str, page_number: int):
+    job = get_page_job(job_id)
+    if not 1 <= page_number <= job.page_count:
+        raise HTTPException(status_code=404, detail=f"Page not found, the PDF has {job.page_count} pages")
+    try:
+        await asyncio.wait_for(job.ready[page_number - 1].wait(), PAGE_WAIT_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="Page is still rendering, try again")
+    path = job.folder / page_name(page_number, job.format)
+    if job.error is not None and not path.exists():
+        raise HTTPException(status_code=500, detail=f"Error during conversion: {job.error}")
+    return FileResponse(path, media_type=FORMATS[job.format])
+
+
+# thumbnail pyramid: every page is rendered once at the largest dpi and scaled
+# down for the others. results go into the render cache, so asking again for
+# any size that was already made renders nothing
+
+@app.post("/convert-pdf-to-jpg/pyramid")
+async def render_pyramid(
+    file: UploadFile = File(...),
+    dpis: str = Form("72,150,300"),
+    format: str = Form("jpg"),
+    quality: int = Form(DEFAULT_QUALITY)
+):
+    if not file.filename.lower().endswith(".pdf"):
+        return pdf_only_error()
+    format = format.lower()
+    try:
+        dpi_list = parse_dpis(dpis)
+        check_options(dpi_list, format, quality)
+    except ValueError as e:
+        return options_error(e)
+
+    unique_id = str(uuid.uuid4())
+    file_path, digest = await save_upload(file, unique_id)
+    try:
+        page_count = await get_page_count(file_path, digest)
+        rendered = 0
+        async for _ in render_pages(file_path, digest, page_count, dpi_list, format, quality, load_cached=False):
+            rendered += 1
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={"status": "error", "message": f"Error during conversion: {str(e)}"}
+        )
+    finally:
+        if file_path.exists():
+            file_path.unlink()
+
+    base_url = "http://127.0.0.1:8000"
+    return {
+        "status": "success",
+        "message": "pages rendered" if rendered else "all sizes were already rendered",
+        "sha256": digest,
+        "pages": page_count,
+        "format": format,
+        "rendered_pages": rendered,
+        "cached_pages": page_count - rendered,
+        "manifest": render_cache.manifest(digest),
+        "sizes": {
+            dpi: [
+                base_url + render_cache.url(render_cache.make_key(digest, page_number, dpi, format, quality))
+                for page_number in range(1, page_count + 1)
+            ]
+            for dpi in dpi_list
+        },
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    return {**render_stats.snapshot(), "cache": render_cache.stats()}
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
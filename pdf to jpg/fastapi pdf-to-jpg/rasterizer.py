@@ -0,0 +1,150 @@
+
+# rasterizer.py
+
+# renders pdf pages to jpg (or png / webp) on several cores. the page range is cut into small
+# shards, each shard runs in a worker process that opens the document itself
+# (fitz documents can't be shared between processes) and hands back the
+# encoded pages, which the caller streams into a zip or writes out as they come.
+
+import io
+import math
+import threading
+import time
+
+import fitz
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# format -> media type. webp goes through pillow, mupdf can't write it
+FORMATS = {
+    "jpg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+}
+# mupdf's own default for jpg
+DEFAULT_QUALITY = 95
+MAX_DPI = 600
+
+# a few shards per worker so a slow shard (big scans) doesn't leave the others idle
+SHARDS_PER_WORKER = 3
+MAX_SHARD_PAGES = 32
+
+
+def count_pages(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
+
+
+def plan_shards(pages, workers):
+    # pages is a sorted list of 0-based page indexes (all of them, or only the
+    # ones missing from the cache). the first page gets a shard of its own so a
+    # client waiting for it doesn't wait for its neighbours
+    if not pages:
+        return []
+    size = math.ceil(len(pages) / (max(workers, 1) * SHARDS_PER_WORKER))
+    size = max(1, min(size, MAX_SHARD_PAGES))
+    return [pages[:1]] + [pages[start:start + size] for start in range(1, len(pages), size)]
+
+
+def check_options(dpis, fmt, quality):
+    # raises ValueError with a message fit for the client
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+    if fmt == "webp" and Image is None:
+        raise ValueError("webp output needs Pillow installed")
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    if not dpis:
+        raise ValueError("at least one dpi is needed")
+    for dpi in dpis:
+        if not 18 <= dpi <= MAX_DPI:
+            raise ValueError(f"dpi must be between 18 and {MAX_DPI}")
+
+
+def parse_dpis(value):
+    # "72, 150,300" -> [72, 150, 300]
+    try:
+        dpis = sorted({int(part) for part in value.replace(" ", "").split(",") if part})
+    except ValueError:
+        raise ValueError(f"Invalid dpi list '{value}'")
+    return dpis
+
+
+def encode(pix, fmt, quality):
+    if fmt == "jpg":
+        return pix.tobytes("jpg", jpg_quality=quality)
+    if fmt == "png":
+        return pix.tobytes("png")
+    image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    buffer = io.BytesIO()
+    image.save(buffer, "WEBP", quality=quality, method=4)
+    return buffer.getvalue()
+
+
+def render_page(page, dpis, fmt, quality):
+    # one render at the largest dpi, the smaller sizes are scaled down from it
+    dpis = sorted(dpis, reverse=True)
+    top = page.get_pixmap(dpi=dpis[0])
+    images = {dpis[0]: encode(top, fmt, quality)}
+    for dpi in dpis[1:]:
+        scale = dpi / dpis[0]
+        pix = fitz.Pixmap(top, max(1, round(top.width * scale)), max(1, round(top.height * scale)), None)
+        images[dpi] = encode(pix, fmt, quality)
+    return images
+
+
+def render_shard(pdf_path, pages, dpis, fmt="jpg", quality=DEFAULT_QUALITY):
+    # runs in a worker process, returns [(page_number, {dpi: image bytes}, seconds), ...]
+    rendered = []
+    with fitz.open(pdf_path) as doc:
+        for page_number in pages:
+            began = time.perf_counter()
+            images = render_page(doc.load_page(page_number), dpis, fmt, quality)
+            rendered.append((page_number + 1, images, time.perf_counter() - began))
+    return rendered
+
+
+def page_name(page_number, fmt="jpg"):
+    return f"page_{page_number}.{fmt}"
+
+
+class RenderStats:
+    # running totals for GET /metrics
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.pages = 0
+        self.wall_seconds = 0.0
+        self.render_seconds = 0.0
+        self.last_job = None
+
+    def record(self, pages, wall_seconds, render_seconds):
+        with self._lock:
+            self.jobs += 1
+            self.pages += pages
+            self.wall_seconds += wall_seconds
+            self.render_seconds += render_seconds
+            self.last_job = {
+                "pages": pages,
+                "seconds": round(wall_seconds, 3),
+                "pages_per_sec": round(pages / wall_seconds, 2) if wall_seconds else None,
+            }
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "jobs": self.jobs,
+                "pages": self.pages,
+                # what a client sees, all workers together
+                "pages_per_sec": round(self.pages / self.wall_seconds, 2) if self.wall_seconds else None,
+                # what one worker manages on its own, multiply by workers to size the pool
+                "pages_per_sec_per_worker": round(self.pages / self.render_seconds, 2) if self.render_seconds else None,
+                "last_job": self.last_job,
+            }
@@ -0,0 +1,151 @@
+
+# render_cache.py
+
+# disk cache of rendered pages, keyed by (sha256 of the pdf, page, dpi, format,
+# quality). files live under the cache root as
+#
+#   <sha256>/<variant>/<dpi>/page_<n>.<format>
+#
+# where a variant is the format plus the quality ("jpg-q95", "webp-q80", "png").
+# entries are kept in LRU order and the least recently used pages are deleted
+# once the cache grows past max_bytes. index.json remembers the entries (and the
+# page count of every document) between restarts.
+
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+
+def variant_name(fmt, quality):
+    # png is lossless, the quality setting doesn't change it
+    return fmt if fmt == "png" else f"{fmt}-q{quality}"
+
+
+class RenderCache:
+
+    def __init__(self, root, max_bytes=2 * 1024 * 1024 * 1024):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True)
+        self.index_path = self.root / "index.json"
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+        # key -> size in bytes, least recently used first
+        self._entries = OrderedDict()
+        # sha256 -> page count
+        self._documents = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @staticmethod
+    def make_key(digest, page_number, dpi, fmt, quality):
+        return f"{digest}/{variant_name(fmt, quality)}/{dpi}/page_{page_number}.{fmt}"
+
+    def path(self, key):
+        # the key doubles as the path of the file below the root
+        return self.root / key
+
+    def url(self, key):
+        return f"/{self.root.name}/{key}"
+
+    def _load(self):
+        try:
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._documents = index.get("documents", {})
+        for key, size in index.get("entries", []):
+            if self.path(key).exists():
+                self._entries[key] = size
+                self.total_bytes += size
+        # the limit may have been lowered since the last run
+        self._evict()
+
+    def flush(self):
+        # written once per request rather than once per page
+        with self._lock:
+            index = {"documents": self._documents, "entries": list(self._entries.items())}
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _evict(self):
+        while self._entries and self.total_bytes > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+    def page_count(self, digest):
+        return self._documents.get(digest)
+
+    def set_page_count(self, digest, page_count):
+        with self._lock:
+            self._documents[digest] = page_count
+
+    def get(self, key):
+        # path of the cached page, or None
+        with self._lock:
+            size = self._entries.get(key)
+            if size is not None and not self.path(key).exists():
+                # the file was removed behind our back
+                del self._entries[key]
+                self.total_bytes -= size
+                size = None
+            if size is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self.path(key)
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # write next to the target and rename, a reader never sees half a file
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._evict()
+
+    def manifest(self, digest):
+        # what is cached for a document: {variant: {dpi: pages cached}}
+        variants = {}
+        prefix = f"{digest}/"
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+        for key in keys:
+            _, variant, dpi, _ = key.split("/")
+            counts = variants.setdefault(variant, {})
+            counts[int(dpi)] = counts.get(int(dpi), 0) + 1
+        return {"sha256": digest, "pages": self._documents.get(digest), "variants": variants}
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "documents": len(self._documents),
+                "size_mb": round(self.total_bytes / (1024 * 1024), 2),
+                "max_mb": round(self.max_bytes / (1024 * 1024), 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
@@ -0,0 +1,62 @@
+
+# upload spooling, streamed zips and download headers, shared by the fastapi services. a service
+# puts the project folder on sys.path and imports from shared.transfer
+
+import io
+import os
+import hashlib
+from urllib.parse import quote
+
+
+# uploads are streamed to disk in chunks of this size so memory per request stays flat
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+async def spool_upload(file, dest_path):
+    # write the upload (a fastapi UploadFile) to dest_path chunk by chunk, hashing
+    # as we go. returns (sha256 hex digest, size in bytes); a failed write leaves
+    # no partial file behind
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(dest_path, "wb") as buffer:
+            while True:
+                chunk = await file.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                buffer.write(chunk)
+                size += len(chunk)
+    except Exception:
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+        raise
+    return sha256.hexdigest(), size
+
+
+def content_disposition(filename, inline=False):
+    # header values must be latin-1, so the plain filename gets an ascii fallback
+    # and the real name goes in filename* (rfc 5987)
+    kind = "inline" if inline else "attachment"
+    ascii_name = filename.encode("ascii", "replace").decode().replace('"', "")
+    return f"{kind}; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+
+class ZipSink(io.RawIOBase):
+    # write-only, unseekable target for zipfile. take() hands out what has been
+    # written so far, so a streamed archive never sits in memory as a whole
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
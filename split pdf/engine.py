@@ -0,0 +1,195 @@
+
+# split engine for the split fastapi
+
+# the input is memory mapped and only the cross-reference table is read when it
+# is opened. pages are found by walking the page tree with each node's /Count,
+# so pulling a few pages out of a huge document only resolves the tree nodes on
+# the way down and the objects those pages use.
+
+import os
+import re
+import sys
+import mmap
+import shutil
+import zipfile
+import tempfile
+from PyPDF2 import PdfReader, PdfWriter, PageObject
+from PyPDF2.generic import NameObject
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.transfer import ZipSink
+
+
+# attributes a page inherits from its ancestors in the page tree
+INHERITABLE = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+
+class LazyPdf:
+
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.reader = PdfReader(self._map)
+        except Exception:
+            self.close()
+            raise
+        self._root_ref = self.reader.trailer["/Root"].raw_get("/Pages")
+
+    @property
+    def page_count(self):
+        return int(self._root_ref.get_object()["/Count"])
+
+    def page(self, index):
+        # walk down from the root, skipping whole subtrees by their /Count
+        if not 0 <= index < self.page_count:
+            raise IndexError(f"page {index + 1} is out of range")
+
+        node_ref = self._root_ref
+        inherited = {}
+        while True:
+            node = node_ref.get_object()
+            for key in INHERITABLE:
+                if key in node:
+                    inherited[key] = node.raw_get(key)
+            if node.get("/Type") == "/Page" or "/Kids" not in node:
+                break
+            kids = node["/Kids"]
+            if int(node.get("/Count", -1)) == len(kids) and kids[index].get_object().get("/Type") == "/Page":
+                # as many pages as kids usually means every kid is a page, but a kid
+                # may still be a one page node, so only shortcut onto a real page
+                node_ref = kids[index]
+                continue
+            for kid_ref in kids:
+                kid = kid_ref.get_object()
+                count = int(kid.get("/Count", 1)) if kid.get("/Type") != "/Page" else 1
+                if index < count:
+                    node_ref = kid_ref
+                    break
+                index -= count
+            else:
+                raise IndexError("page tree is broken")
+
+        page = PageObject(self.reader, node_ref)
+        page.update(node)
+        for key, value in inherited.items():
+            if key not in node:
+                page[NameObject(key)] = value
+        return page
+
+    def close(self):
+        if getattr(self, "_map", None) is not None:
+            # PyPDF2 may still hold slices, drop our references before unmapping
+            self.reader = None
+            try:
+                self._map.close()
+            except BufferError:
+                pass
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def write_pages(pdf, indexes, output_path):
+    # indexes are 0-based
+    writer = PdfWriter()
+    for index in indexes:
+        writer.add_page(pdf.page(index))
+    with open(output_path, "wb") as f:
+        writer.write(f)
+
+
+# multi part splitting: a range expression, a fixed burst size or the top level
+# bookmarks each produce a list of (first, last) 1-based inclusive page ranges
+
+def parse_ranges(expression, total_pages):
+    # "1-3,7,10-end" -> [(1, 3), (7, 7), (10, total_pages)]
+    ranges = []
+    for token in expression.replace(" ", "").split(","):
+        if not token:
+            continue
+        match = re.fullmatch(r"(\d+|end)(?:-(\d+|end))?", token.lower())
+        if match is None:
+            raise ValueError(f"Invalid page range '{token}'")
+        first, last = match.group(1), match.group(2) or match.group(1)
+        first = total_pages if first == "end" else int(first)
+        last = total_pages if last == "end" else int(last)
+        if first < 1 or last > total_pages or first > last:
+            raise ValueError(f"Invalid page range '{token}'. The PDF has {total_pages} pages.")
+        ranges.append((first, last))
+    if not ranges:
+        raise ValueError("No page ranges given")
+    return ranges
+
+
+def burst_ranges(every, total_pages):
+    if every < 1:
+        raise ValueError("Burst size must be at least 1")
+    return [(first, min(first + every - 1, total_pages)) for first in range(1, total_pages + 1, every)]
+
+
+def bookmark_ranges(pdf):
+    # one part per top level bookmark, pages before the first one form their own part
+    reader = pdf.reader
+    starts = []
+    for item in reader.outline:
+        if isinstance(item, list):
+            continue
+        try:
+            page = reader.get_destination_page_number(item)
+        except Exception:
+            continue
+        if page is not None and page >= 0:
+            starts.append((page + 1, item.title or ""))
+    if not starts:
+        raise ValueError("The PDF has no bookmarks")
+
+    starts.sort(key=lambda start: start[0])
+    if starts[0][0] > 1:
+        starts.insert(0, (1, ""))
+    ranges = []
+    for index, (first, title) in enumerate(starts):
+        last = starts[index + 1][0] - 1 if index + 1 < len(starts) else pdf.page_count
+        # several bookmarks on one page collapse into the last of them
+        if last >= first:
+            ranges.append((first, last, title))
+    return ranges
+
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _part_name(base_name, number, first, last, title=""):
+    name = f"{base_name}_part{number:03d}_p{first}-{last}"
+    title = re.sub(r"[^\w\- ]+", "", title).strip().replace(" ", "_")[:50]
+    if title:
+        name += f"_{title}"
+    return f"{name}.pdf"
+
+
+def iter_zip_parts(path, ranges, base_name):
+    # yields the zip archive piece by piece, one piece per finished part
+    sink = ZipSink()
+    with LazyPdf(path) as pdf, zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for number, page_range in enumerate(ranges, start=1):
+            first, last = page_range[0], page_range[1]
+            title = page_range[2] if len(page_range) > 2 else ""
+            writer = PdfWriter()
+            for index in range(first - 1, last):
+                writer.add_page(pdf.page(index))
+            # PdfWriter needs a seekable stream, so the part goes through a temp
+            # file on disk rather than straight into the zip entry
+            with tempfile.TemporaryFile() as part:
+                writer.write(part)
+                part.seek(0)
+                with archive.open(_part_name(base_name, number, first, last, title), "w") as entry:
+                    shutil.copyfileobj(part, entry, COPY_CHUNK_SIZE)
+            yield sink.take()
+    # central directory, written when the archive closes
+    yield sink.take()
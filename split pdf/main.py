@@ -2,21 +2,28 @@
 # fapi_split.py
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from PyPDF2 import PdfReader, PdfWriter
 import os
-import tempfile
+import sys
 import uuid
+from typing import Optional
 from pydantic import BaseModel
 
+from engine import LazyPdf, write_pages, parse_ranges, burst_ranges, bookmark_ranges, iter_zip_parts
+
+# helpers shared by the apis live in the project's shared folder
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared.transfer import content_disposition, spool_upload
+
 app = FastAPI()
 
 STATIC_DIR = "splitted_pdf"
+UPLOAD_DIR = "uploaded_pdfs"
 os.makedirs(STATIC_DIR, exist_ok=True)
-#
-os.makedirs("uploaded_pdfs", exist_ok=True)
-#
+os.makedirs(UPLOAD_DIR, exist_ok=True)
+
+
 app.mount("/files", StaticFiles(directory=STATIC_DIR), name="files")
 
 class ResponseModel(BaseModel):
@@ -24,14 +31,13 @@ class ResponseModel(BaseModel):
     message: str
     download_link: str = None
 
+
 @app.post("/split-pdf", response_model=ResponseModel)
 async def split_pdf(
     file: UploadFile = File(...),
     start_page: int = Form(...),
     end_page: int = Form(...)
 ):
-    tmp_path = None
-    
     # Check if file is a PDF
     if not file.filename.lower().endswith('.pdf'):
         return JSONResponse(
@@ -43,40 +49,28 @@ async def split_pdf(
         )
     
     try:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-
-        # Read the PDF
-        pdf = PdfReader(tmp_path)
-        total_pages = len(pdf.pages)
-
-        # Validate range
-        if start_page < 1 or end_page > total_pages or start_page > end_page:
-            return JSONResponse(
-                status_code=400,
-                content={
-                    "status": "error",
-                    "message": f"Invalid page range. The PDF has {total_pages} pages."
-                }
-            )
-
-        # Split pages
-        pdf_writer = PdfWriter()
-        for page_num in range(start_page - 1, end_page):
-            pdf_writer.add_page(pdf.pages[page_num])
-
-        #
-        upload_path = os.path.join("uploaded_pdfs", f"{uuid.uuid4()}.pdf")
-        with open(upload_path, "wb") as buffer:
-            buffer.write(await file.read())
-        #
-        unique_filename = f"{uuid.uuid4()}.pdf"
-        output_path = os.path.join(STATIC_DIR, unique_filename)
-
-        with open(output_path, "wb") as f:
-            pdf_writer.write(f)
+        # Save the upload once, it doubles as the archived copy
+        upload_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.pdf")
+        await spool_upload(file, upload_path)
+
+        # Open lazily, only the pages we copy get parsed
+        with LazyPdf(upload_path) as pdf:
+            total_pages = pdf.page_count
+
+            # Validate range
+            if start_page < 1 or end_page > total_pages or start_page > end_page:
+                return JSONResponse(
+                    status_code=400,
+                    content={
+                        "status": "error",
+                        "message": f"Invalid page range. The PDF has {total_pages} pages."
+                    }
+                )
+
+            # Split pages
+            unique_filename = f"{uuid.uuid4()}.pdf"
+            output_path = os.path.join(STATIC_DIR, unique_filename)
+            write_pages(pdf, range(start_page - 1, end_page), output_path)
 
         base_url = "http://127.0.0.1:8000"  # In production, use request.base_url
         download_link = f"{base_url}/files/{unique_filename}"
@@ -95,6 +89,67 @@ async def split_pdf(
                 "message": f"An error occurred: {str(e)}"
             }
         )
-    finally:
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+
+@app.post("/split-pdf-zip")
+async def split_pdf_zip(
+    file: UploadFile = File(...),
+    ranges: Optional[str] = Form(None, description='Page ranges, e.g. "1-3,7,10-end"'),
+    every: Optional[int] = Form(None, description="Burst into parts of this many pages"),
+    by_bookmark: bool = Form(False, description="One part per top level bookmark")
+):
+    # Check if file is a PDF
+    if not file.filename.lower().endswith('.pdf'):
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": "Only PDF files are allowed"
+            }
+        )
+
+    if sum([ranges is not None, every is not None, by_bookmark]) != 1:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": "Give exactly one of ranges, every or by_bookmark"
+            }
+        )
+
+    try:
+        upload_path = os.path.join(UPLOAD_DIR, f"{uuid.uuid4()}.pdf")
+        await spool_upload(file, upload_path)
+
+        # Work out every part up front so bad input is reported before streaming starts
+        with LazyPdf(upload_path) as pdf:
+            if ranges is not None:
+                parts = parse_ranges(ranges, pdf.page_count)
+            elif every is not None:
+                parts = burst_ranges(every, pdf.page_count)
+            else:
+                parts = bookmark_ranges(pdf)
+
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+    except Exception as e:
+        return JSONResponse(
+            status_code=500,
+            content={
+                "status": "error",
+                "message": f"An error occurred: {str(e)}"
+            }
+        )
+
+    base_name = os.path.splitext(os.path.basename(file.filename))[0]
+    return StreamingResponse(
+        iter_zip_parts(upload_path, parts, base_name),
+        media_type="application/zip",
+        headers={"Content-Disposition": content_disposition(f"{base_name}_split.zip")}
+    )